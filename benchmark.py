@@ -0,0 +1,233 @@
+import os, sys, json, time, random, shutil, tempfile, argparse, platform, subprocess, multiprocessing
+from PIL import Image, ImageDraw
+import PIL
+import numpy as np
+from mixer import Mixer
+
+
+def create_components(path, layers, items, size, transparency, rules, rarity, seed):
+    # Writes components directory, layers order file and exceptions file of given shape into 'path'
+    rng = random.Random(seed)
+    noise = np.random.default_rng(seed)
+    components_path = path + '/components'
+    layer_names = [f'layer{l}' for l in range(layers)]
+    item_names = [[f'item{l}_{i}' for i in range(items)] for l in range(layers)]
+
+    for l, layer in enumerate(layer_names):
+        os.makedirs(f'{components_path}/{layer}')
+        for name in item_names[l]:
+            # Colour with some noise, so images are not compressed unrealistically well
+            color = [rng.randint(0, 255) for _ in range(3)]
+            pixels = np.clip(noise.normal(0, 12, (size[1], size[0], 3)) + color, 0, 255).astype(np.uint8)
+            image = Image.fromarray(pixels, 'RGB').convert('RGBA')
+
+            if l:
+                # Every layer except the first one covers only (1 - transparency) of the image with an ellipse
+                coverage = max(0.0, min(1.0, 1 - transparency))
+                mask = Image.new('L', size, 0)
+                if coverage:
+                    scale = min(1.0, (coverage * 4 / np.pi) ** 0.5)
+                    width, height = max(1, int(size[0] * scale)), max(1, int(size[1] * scale))
+                    left, top = rng.randint(0, size[0] - width), rng.randint(0, size[1] - height)
+                    ImageDraw.Draw(mask).ellipse([left, top, left + width - 1, top + height - 1], fill=255)
+                image.putalpha(mask)
+            image.save(f'{components_path}/{layer}/{name}.png')
+
+        if rarity:
+            groups = {}
+            for name in item_names[l]:
+                groups.setdefault(rng.randint(1, 5), []).append(name)
+            with open(f'{components_path}/{layer}/rarity.json', 'w') as file:
+                file.write(json.dumps([{'weight': weight, 'items': groups[weight]} for weight in sorted(groups)]))
+
+    layers_order_path = path + '/layers.json'
+    with open(layers_order_path, 'w') as file:
+        file.write('\n'.join(layer_names))
+
+    exceptions_path = None
+    if rules and layers > 1:
+        exception_list = []
+        for r in range(rules):
+            first, second = rng.sample(range(layers), 2)
+            item = rng.choice(item_names[first])
+            # Every tenth rule removes whole layer, the rest forbid pair of items
+            exception_list.append([item, layer_names[second] + '/'] if r % 10 == 9 else [item, rng.choice(item_names[second])])
+        exceptions_path = path + '/exceptions.json'
+        with open(exceptions_path, 'w') as file:
+            file.write(json.dumps(exception_list))
+
+    return components_path, layers_order_path, exceptions_path
+
+def create_mixer(components_path, layers_order_path, exceptions_path, manifest_path=None):
+    mixer = Mixer()
+    mixer.components_path = components_path
+    mixer.layers_order_path = layers_order_path
+    mixer.exceptions_path = exceptions_path
+    mixer.rarity_filename = 'rarity.json'
+    mixer.manifest_path = manifest_path
+    return mixer
+
+def measure(function, repeat):
+    # Returns the best time of 'repeat' runs, function gets number of the run
+    best = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        function(r)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def get_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except:
+        return None
+
+def run_benchmarks(args, path):
+    components_path, layers_order_path, exceptions_path = create_components(path, args.layers, args.items, (args.size, args.size), args.transparency, args.rules, args.rarity, args.seed)
+    results = {}
+
+    def add(name, seconds, count=1):
+        results[name] = {'seconds': seconds, 'count': count, 'per_second': count / seconds if seconds else 0}
+
+    # Loading components from scratch and with manifest of previous scan
+    add('fetch_data', measure(lambda r: create_mixer(components_path, layers_order_path, exceptions_path).fetch_data(), args.repeat))
+    manifest_path = path + '/manifest.json'
+    create_mixer(components_path, layers_order_path, exceptions_path, manifest_path).fetch_data()
+    add('fetch_data_manifest', measure(lambda r: create_mixer(components_path, layers_order_path, exceptions_path, manifest_path).fetch_data(), args.repeat))
+
+    # The same images are generated in every run, first with empty layer cache, then with filled one
+    mixer = create_mixer(components_path, layers_order_path, exceptions_path)
+    mixer.fetch_data()
+    mixer.collection_seed = args.seed
+    mixer.encoder = args.encoder
+
+    def generate(r):
+        for token in range(args.images):
+            mixer.generate(token)
+
+    def generate_cold(r):
+        mixer.layer_cache.clear()
+        mixer.prefix_cache.clear()
+        generate(r)
+
+    add('generate_cold', measure(generate_cold, args.repeat), args.images)
+    add('generate', measure(generate, args.repeat), args.images)
+
+    # Only saving is measured, images are generated beforehand
+    results_to_save = [mixer.generate_image(token) for token in range(min(args.images, args.save_images))]
+
+    def save(r):
+        output = f'{path}/save{r}'
+        os.makedirs(output)
+        for number, result in enumerate(results_to_save, 1):
+            mixer.save(output, number, result)
+
+    add('save', measure(save, args.repeat), len(results_to_save))
+
+    add('sample_batch', measure(lambda r: mixer.sample_batch(args.batch), args.repeat), args.batch)
+
+    def generate_batch(r):
+        output = f'{path}/batch{r}'
+        os.makedirs(output)
+        mixer.generate_batch(args.batch, output, args.workers)
+
+    add('generate_batch', measure(generate_batch, args.repeat), args.batch)
+
+    return results, mixer.get_timings()['stages']
+
+def compare(results, baseline, threshold):
+    # Prints time of every benchmark relative to baseline, returns names of benchmarks slower than threshold
+    if baseline.get('config') != results['config']:
+        print('WARNING: Baseline was measured with different configuration!', file=sys.stderr)
+
+    regressions = []
+    for name, result in results['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if not old or not old['seconds']:
+            continue
+        ratio = result['seconds'] / old['seconds']
+        if ratio > 1 + threshold:
+            regressions.append(name)
+        print(f'{name:<24}{old["seconds"]:>10.3f}s{result["seconds"]:>10.3f}s{ratio:>9.2f}x{"  SLOWER" if name in regressions else ""}', file=sys.stderr)
+
+    return regressions
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(prog='python benchmark.py', description='Measure speed of Mixer on synthetic components.')
+    parser.add_argument('--layers', type=int, default=5, help='number of layers (default: 5)')
+    parser.add_argument('--items', type=int, default=10, help='number of items in every layer (default: 10)')
+    parser.add_argument('--size', type=int, default=512, help='width and height of images in pixels (default: 512)')
+    parser.add_argument('--transparency', type=float, default=0.6, help='transparent part of every layer except the first one (default: 0.6)')
+    parser.add_argument('--rules', type=int, default=10, help='number of exception rules (default: 10)')
+    parser.add_argument('--no-rarity', dest='rarity', action='store_false', help='don\'t write rarity files')
+    parser.add_argument('--images', type=int, default=100, help='number of images generated one by one (default: 100)')
+    parser.add_argument('--save-images', type=int, default=20, help='number of images saved one by one (default: 20)')
+    parser.add_argument('--batch', type=int, default=500, help='number of images sampled and generated in batch (default: 500)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes of batch (default: number of CPUs)')
+    parser.add_argument('--encoder', default='png', help='output format (default: png)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of every benchmark, the best one is reported (default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of synthetic components and generated images (default: 0)')
+    parser.add_argument('--out', default=None, help='file for JSON results (default: standard output)')
+    parser.add_argument('--compare', default=None, help='JSON results of previous run, exit code is 1 if any benchmark got slower')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed slowdown relative to compared results (default: 0.1)')
+    parser.add_argument('--keep', default=None, help='directory for synthetic components and outputs, kept after benchmark')
+    return parser.parse_args(args)
+
+def main(args=None):
+    args = parse_arguments(args)
+    config = {key: value for key, value in vars(args).items() if not key in ['out', 'compare', 'threshold', 'keep']}
+
+    if args.keep:
+        if os.path.exists(args.keep):
+            print(f'ERROR: {args.keep} already exists!', file=sys.stderr)
+            return 1
+        os.makedirs(args.keep)
+        path = args.keep
+    else:
+        path = tempfile.mkdtemp(prefix='nftmixer-benchmark-')
+
+    try:
+        results, stages = run_benchmarks(args, path)
+    finally:
+        if not args.keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+    report = {
+        'commit': get_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count()
+        },
+        'config': config,
+        'results': results,
+        'stages': stages
+    }
+
+    data = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as file:
+            file.write(data)
+    else:
+        print(data)
+
+    for name, result in results.items():
+        print(f'{name:<24}{result["seconds"]:>10.3f}s{result["per_second"]:>12.1f}/s', file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.loads(file.read())
+        if compare(report, baseline, args.threshold):
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,4 +4,20 @@ class ComponentsPathError(Exception):
 
 class LayersOrderFileError(Exception):
     def __str__(self):
-        return 'There was an error with layers order file!'
\ No newline at end of file
+        return 'There was an error with layers order file!'
+
+class CombinationsExhaustedError(Exception):
+    def __str__(self):
+        return 'There are no more unique combinations left!'
+
+class UniquenessFileError(Exception):
+    def __str__(self):
+        return 'There was an error with file of generated combinations!'
+
+class AssetPackError(Exception):
+    def __str__(self):
+        return 'There was an error with asset pack file!'
+
+class CheckpointFileError(Exception):
+    def __str__(self):
+        return 'There was an error with checkpoint file!'
@@ -1,6 +1,543 @@
-import os, random, json
-from exceptions import ComponentsPathError, LayersOrderFileError
-from PIL import Image
+import os, sys, io, csv, random, json, threading, multiprocessing, argparse, time, bisect, itertools, queue, mmap, struct
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from exceptions import ComponentsPathError, LayersOrderFileError, CombinationsExhaustedError, UniquenessFileError, AssetPackError, CheckpointFileError
+from PIL import Image, features
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Output formats available for saving images:
+ENCODERS = {
+    'png': {'label': 'PNG', 'format': 'PNG', 'extension': 'png', 'options': {}},
+    'png-fast': {'label': 'PNG (fast)', 'format': 'PNG', 'extension': 'png', 'options': {'compress_level': 1}},
+    'png-store': {'label': 'PNG (uncompressed)', 'format': 'PNG', 'extension': 'png', 'options': {'compress_level': 0}},
+    'webp-lossless': {'label': 'WebP (lossless)', 'format': 'WEBP', 'extension': 'webp', 'options': {'lossless': True, 'quality': 0, 'method': 0}, 'feature': 'webp'},
+    'tiff-raw': {'label': 'TIFF (raw)', 'format': 'TIFF', 'extension': 'tiff', 'options': {'compression': 'raw'}}
+}
+
+# Asset pack layout: magic, offset and length of JSON header (stored at the end), then raw RGBA layers
+ASSET_PACK_MAGIC = b'NFTMIXPK'
+ASSET_PACK_PREAMBLE = struct.Struct('<8sQQ')
+ASSET_PACK_ALIGNMENT = 64
+
+# State of interrupted generating run is kept in output directory under this name
+CHECKPOINT_FILENAME = '.nftmixer-checkpoint'
+
+def get_available_encoders():
+    return [name for name in ENCODERS if not 'feature' in ENCODERS[name] or features.check(ENCODERS[name]['feature'])]
+
+class LayerCache:
+    def __init__(self, budget):
+        self.budget = budget # Maximum number of bytes held by cached images
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            self.items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, size):
+        if size > self.budget:
+            return
+
+        with self.lock:
+            if key in self.items:
+                self.size -= self.items.pop(key)[1]
+            self.items[key] = (value, size)
+            self.size += size
+
+            # Evict least recently used items until the budget is respected:
+            while self.size > self.budget:
+                _, (_, evicted) = self.items.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def __getstate__(self):
+        # Decoded images are not sent to worker processes, every worker fills its own cache
+        return {'budget': self.budget}
+
+    def __setstate__(self, state):
+        self.__init__(state['budget'])
+
+class StageTimings:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.started = time.perf_counter()
+
+    def start(self):
+        # Returns None when disabled, add() then does nothing
+        return time.perf_counter() if self.enabled else None
+
+    def add(self, stage, start):
+        # Records time elapsed since 'start', returns current time so next stage can be measured from it
+        if start is None:
+            return None
+
+        now = time.perf_counter()
+        self.record(stage, 1, now - start, now - start, {(int((now - start) * 1000000)).bit_length(): 1})
+        return now
+
+    def record(self, stage, count, total, maximum, histogram):
+        # Histogram bucket b counts durations from 2^(b-1) up to 2^b microseconds
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = {'count': 0, 'total': 0.0, 'max': 0.0, 'histogram': {}}
+            entry['count'] += count
+            entry['total'] += total
+            entry['max'] = max(entry['max'], maximum)
+            for bucket, n in histogram.items():
+                entry['histogram'][bucket] = entry['histogram'].get(bucket, 0) + n
+
+    def take(self):
+        # Returns recorded stages and starts counting from zero (used to send timings of worker processes)
+        with self.lock:
+            stages = self.stages
+            self.stages = {}
+        return stages
+
+    def merge(self, stages):
+        for stage, entry in stages.items():
+            self.record(stage, entry['count'], entry['total'], entry['max'], entry['histogram'])
+
+    def get(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            report = {'elapsed': elapsed, 'stages': {}}
+            for stage, entry in self.stages.items():
+                report['stages'][stage] = {
+                    'count': entry['count'],
+                    'total': entry['total'],
+                    'mean': entry['total'] / entry['count'] if entry['count'] else 0,
+                    'max': entry['max'],
+                    'per_second': entry['count'] / elapsed if elapsed else 0,
+                    'histogram': {f'<{2 ** bucket}us': entry['histogram'][bucket] for bucket in sorted(entry['histogram'])}
+                }
+        return report
+
+    def __getstate__(self):
+        return {'enabled': self.enabled}
+
+    def __setstate__(self, state):
+        self.__init__(state['enabled'])
+
+class LayerSampler:
+    def __init__(self, items, weights):
+        self.items = tuple(items)
+        self.names = tuple('.'.join(item.split('.')[:-1]) for item in self.items)
+        self.name_set = frozenset(self.names)
+        self.weights = tuple(weights)
+        self.cum_weights = tuple(itertools.accumulate(self.weights))
+        self.total = self.cum_weights[-1] if self.cum_weights else 0
+        self.build_alias_table()
+
+    def build_alias_table(self):
+        # Walker's alias method (Vose's variant) - every draw takes constant time
+        n = len(self.weights)
+        probability = [0.0] * n
+        alias = list(range(n))
+        if self.total > 0:
+            scaled = [weight * n / self.total for weight in self.weights]
+            small = [i for i in range(n) if scaled[i] < 1]
+            large = [i for i in range(n) if scaled[i] >= 1]
+            while small and large:
+                s, l = small.pop(), large.pop()
+                probability[s] = scaled[s]
+                alias[s] = l
+                scaled[l] = scaled[l] + scaled[s] - 1
+                (small if scaled[l] < 1 else large).append(l)
+            for i in small + large:
+                probability[i] = 1.0
+
+        self.probability = tuple(probability)
+        self.alias = tuple(alias)
+        self.weights_array = np.array(self.weights, dtype=np.float64)
+        self.cum_weights_array = np.array(self.cum_weights, dtype=np.float64)
+        self.probability_array = np.array(self.probability, dtype=np.float64)
+        self.alias_array = np.array(self.alias, dtype=np.int32)
+
+    def draw(self, u, blocked=None):
+        # Maps uniform number u from [0, 1) to index of the chosen item, returns None when there is nothing to choose from
+        if self.total <= 0:
+            return None
+
+        if not blocked or blocked.isdisjoint(self.name_set):
+            x = u * len(self.items)
+            i = min(int(x), len(self.items) - 1)
+            return i if x - i < self.probability[i] else self.alias[i]
+
+        # Re-normalise weights over the items that are still allowed:
+        allowed = [i for i in range(len(self.names)) if self.names[i] not in blocked]
+        cum_weights = list(itertools.accumulate(self.weights[i] for i in allowed))
+        if not cum_weights or cum_weights[-1] <= 0:
+            return None
+
+        return allowed[bisect.bisect_right(cum_weights, u * cum_weights[-1])]
+
+    def draw_batch(self, u):
+        # Vectorized version of draw() for rows without blocked items
+        x = u * len(self.items)
+        i = np.minimum(x.astype(np.int64), len(self.items) - 1)
+        return np.where(x - i < self.probability_array[i], i, self.alias_array[i])
+
+    def draw_restricted(self, u, rows, columns):
+        # Vectorized version of draw() for rows with blocked items, see draw_restricted below
+        return draw_restricted(self.weights_array, self.cum_weights_array, u, rows, columns)
+
+def draw_restricted(weights, cum_weights, u, rows, columns):
+    # Same choice as LayerSampler.draw with blocked items, for many rows at once. Blocked items are given
+    # as (row, column) pairs sorted by row and column, so only blocked columns are visited, never the whole layer.
+    # Returns affected rows, chosen index of every affected row (-1 if nothing is allowed) and allowed weight of every row.
+    first = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))
+    affected = rows[first]
+    counts = np.diff(np.append(first, len(rows)))
+    blocked_weights = weights[columns]
+    totals = cum_weights[-1] - np.add.reduceat(blocked_weights, first)
+    targets = u[affected] * totals
+
+    # Allowed weight before every blocked item: full cumulative weight minus blocked weight before it in the same row
+    cum_blocked = np.cumsum(blocked_weights) - blocked_weights
+    cum_blocked -= np.repeat(cum_blocked[first], counts)
+    starts = cum_weights[columns] - blocked_weights - cum_blocked
+
+    # Target skips every blocked item which starts at or before it (in allowed weights), the rest lies after the choice
+    shifts = np.add.reduceat(np.where(starts <= np.repeat(targets, counts), blocked_weights, 0), first)
+    indices = np.minimum(np.searchsorted(cum_weights, targets + shifts, side='right'), len(weights) - 1)
+    return affected, np.where(totals > 0, indices, -1), totals
+
+# Counter-based random numbers (SplitMix64 mixing): every image has a 64-bit key and its n-th random
+# number depends only on (key, n), so results don't depend on order of generating or number of workers.
+MASK64 = 0xffffffffffffffff
+GOLDEN_GAMMA = 0x9e3779b97f4a7c15
+
+def mix64(x):
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK64
+    return x ^ (x >> 31)
+
+def mix64_array(x):
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+def get_token_key(seed, token):
+    return mix64((mix64(seed & MASK64) + (token + 1) * GOLDEN_GAMMA) & MASK64)
+
+def get_token_keys(seed, tokens):
+    tokens = np.asarray(tokens, dtype=np.uint64)
+    return mix64_array(np.uint64(mix64(seed & MASK64)) + (tokens + np.uint64(1)) * np.uint64(GOLDEN_GAMMA))
+
+def get_uniforms(keys, counters):
+    # Vectorized TokenRandom: n-th random number of every key
+    x = mix64_array(keys + (np.asarray(counters, dtype=np.uint64) + np.uint64(1)) * np.uint64(GOLDEN_GAMMA))
+    return (x >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+class TokenRandom:
+    def __init__(self, key):
+        self.key = key
+        self.counter = 0
+
+    def random(self):
+        x = mix64((self.key + (self.counter + 1) * GOLDEN_GAMMA) & MASK64)
+        self.counter += 1
+        return (x >> 11) * 2.0 ** -53
+
+class UniqueCombinations:
+    def __init__(self, radices):
+        self.radices = tuple(radices) # Number of items in every layer + 1 for 'none'
+        combinations = 1
+        for radix in self.radices:
+            combinations *= radix
+        self.width = max(1, ((combinations - 1).bit_length() + 7) // 8)
+        self.dtype = np.dtype(f'V{self.width}')
+        self.keys = np.empty(0, dtype=self.dtype) # Sorted big-endian keys, 'width' bytes per combination
+        self.pending = set()
+        self.lock = threading.RLock() # Checking and adding combination has to be atomic when generating in many threads
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.keys) + len(self.pending)
+
+    def encode(self, indices):
+        # Packs trait indices into single integer (mixed radix over layer sizes)
+        key = 0
+        for radix, index in zip(self.radices, indices):
+            key = key * radix + index + 1
+        return key.to_bytes(self.width, 'big')
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.pending:
+                return True
+            position = np.searchsorted(self.keys, np.array([key], dtype=self.dtype))[0]
+            return position < len(self.keys) and self.keys[position].tobytes() == key
+
+    def add(self, indices):
+        # Returns False if combination was already seen
+        key = self.encode(indices)
+        with self.lock:
+            if key in self:
+                return False
+
+            self.pending.add(key)
+            if len(self.pending) > max(65536, len(self.keys) // 8):
+                self.merge()
+            return True
+
+    def merge(self):
+        with self.lock:
+            if self.pending:
+                pending = np.array(list(self.pending), dtype=self.dtype)
+                self.keys = np.sort(np.concatenate([self.keys, pending]))
+                self.pending = set()
+
+    def save(self, path):
+        with self.lock:
+            self.merge()
+            with open(path, 'wb') as file:
+                np.savez(file, radices=np.array(self.radices, dtype=np.int64), keys=self.keys)
+
+    def load(self, path):
+        try:
+            with np.load(path) as file:
+                radices = tuple(file['radices'].tolist())
+                keys = file['keys']
+        except:
+            raise UniquenessFileError
+
+        if radices != self.radices or keys.dtype != self.dtype:
+            raise UniquenessFileError
+
+        with self.lock:
+            self.keys = keys
+            self.pending = set()
+
+class OutputCounter:
+    filename = '.nftmixer-counter'
+
+    def __init__(self, path, scan):
+        self.path = path + '/' + self.filename
+        self.scan = scan # Used only when counter file doesn't exist yet
+        self.lock = threading.Lock()
+
+    def lock_file(self, file):
+        if fcntl:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+
+    def unlock_file(self, file):
+        if fcntl:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def read(self, file):
+        # Counter file holds last used number, optionally followed by the generating run which reserved it
+        # and the first number of that run reserved since anything else was saved (see ImageWriter)
+        content = file.read().split()
+        if not content:
+            return None, None, None
+        if len(content) < 3:
+            return int(content[0]), None, None
+        return int(content[0]), content[1], int(content[2])
+
+    def write(self, file, last, run=None, first=None):
+        file.seek(0)
+        file.truncate()
+        file.write(f'{last} {run} {first}' if run else str(last))
+        file.flush()
+
+    def reserve(self, count=1, run=None):
+        # Returns first of 'count' consecutive numbers, safe across threads and processes
+        with self.lock:
+            with open(os.open(self.path, os.O_RDWR | os.O_CREAT), 'r+') as file:
+                self.lock_file(file)
+                try:
+                    last, owner, first = self.read(file)
+                    last = last if last is not None else self.scan()
+                    if owner != run:
+                        first = last + 1
+                    self.write(file, last + count, run, first)
+                finally:
+                    self.unlock_file(file)
+
+        return last + 1
+
+    def release(self, first, count=1):
+        # Gives back numbers returned by reserve() which weren't used, unless other numbers were reserved since
+        with self.lock:
+            with open(os.open(self.path, os.O_RDWR | os.O_CREAT), 'r+') as file:
+                self.lock_file(file)
+                try:
+                    last, run, run_first = self.read(file)
+                    if last == first + count - 1:
+                        self.write(file, first - 1, run, run_first)
+                finally:
+                    self.unlock_file(file)
+
+    def get(self):
+        # Returns (last used number, run, its first number), all None if counter file doesn't exist
+        with self.lock:
+            try:
+                file = open(os.open(self.path, os.O_RDWR), 'r+')
+            except FileNotFoundError:
+                return None, None, None
+            with file:
+                self.lock_file(file)
+                try:
+                    return self.read(file)
+                finally:
+                    self.unlock_file(file)
+
+    def set(self, last, run=None, first=None):
+        # Makes 'last' the last used number, so next reserved number will be last + 1
+        with self.lock:
+            with open(os.open(self.path, os.O_RDWR | os.O_CREAT), 'r+') as file:
+                self.lock_file(file)
+                try:
+                    self.write(file, last, run, first)
+                finally:
+                    self.unlock_file(file)
+
+class ImageWriter:
+    def __init__(self, mixer, path, workers=2, queue_size=8, run=None):
+        self.mixer = mixer
+        self.path = path
+        self.run_id = run # Generating run whose checkpoint is saved into the same directory
+        self.queue = queue.Queue(queue_size) # Bounded, so generation waits when writing falls behind
+        self.error = None # First error of writing threads
+        self.error_raised = False
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, image, traits=None, seed=None):
+        if self.error:
+            self.error_raised = True
+            raise self.error
+
+        # Number is reserved here so images are numbered in order of generation
+        number = self.mixer.reserve_numbers(self.path, run=self.run_id)
+        self.queue.put((image, number, traits, seed))
+        return number
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                break
+
+            image, number, traits, seed = task
+            try:
+                self.mixer.write_image(image, self.path, number)
+                if traits is not None:
+                    self.mixer.record_metadata(self.path, number, traits, seed)
+            except Exception as e:
+                self.error = self.error or e
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        # Waits until all queued images are written, writer can be used further
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        # Waits until all queued images are written
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        self.raise_error()
+
+    def raise_error(self):
+        # Error is raised only once, so closing writer after failed put or wait doesn't report it again
+        if self.error and not self.error_raised:
+            self.error_raised = True
+            raise self.error
+
+class MetadataWriter:
+    def __init__(self, path, layers, format):
+        self.format = format # 'jsonl' or 'csv'
+        self.layers = list(layers)
+        self.lock = threading.Lock()
+        new = not os.path.isfile(path) or not os.path.getsize(path)
+        self.file = open(path, 'a', buffering=1024 * 1024, newline='', encoding='utf-8') # Append-only, written in big chunks
+        if self.format == 'csv':
+            self.writer = csv.writer(self.file)
+            if new:
+                self.writer.writerow(['number', 'seed', *self.layers])
+
+    def write(self, number, traits, seed=None):
+        with self.lock:
+            if self.format == 'csv':
+                self.writer.writerow([number, '' if seed is None else seed, *[traits.get(layer, 'none') for layer in self.layers]])
+            else:
+                self.file.write(json.dumps({'number': number, 'seed': seed, 'traits': traits}) + '\n')
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def init_batch_worker(mixer):
+    global batch_mixer
+    batch_mixer = mixer
+    batch_mixer.timings.take() # Forked workers start with stages already recorded by the parent
+    random.seed() # Forked workers would otherwise share the parent's random state
+
+def generate_batch_item(task):
+    path, number, indices = task
+    start = batch_mixer.timings.start()
+    traits = batch_mixer.get_traits(indices)
+    image = batch_mixer.compose(indices)
+    batch_mixer.timings.add('compose', start)
+    batch_mixer.write_image(image, path, number) # Metadata is recorded by the main process
+    return number, traits, batch_mixer.timings.take() if batch_mixer.timings.enabled else None
+
+class GeneratedImage:
+    def __init__(self, image, traits, seed, indices, preview=False):
+        self.image = image
+        self.traits = traits
+        self.seed = seed
+        self.indices = indices # Index of the chosen item for every layer (-1 means 'none')
+        self.preview = preview # True when image was composed at preview size
 
 class Mixer:
     def __init__(self):
@@ -9,15 +546,69 @@ class Mixer:
         self.total_images = None
         self.skipped_total_images = None
         self.possible_combinations = None
+        self.possible_combinations_exact = False
+        self.effective_combinations = None
+        self.combinations_counted = False # Combinations are counted on demand by count_possible_combinations
+        self.trait_probabilities = None # Computed on demand by compute_trait_probabilities
+        self.trait_probabilities_exact = False
+        self.counting_state_limit = 20000 # Above this number of states combinations are estimated instead of counted
         self.components_path = None
         self.layers_order_path = None
         self.exceptions_path = None
         self.rarity_filename = None
         self.current_image = None
         self.current_traits = {}
+        self.current_seed = None
+        self.current_indices = None
+        self.current_preview = False # True when current_image was composed at preview size
+        self.current_result = None
         self.image_size = (1024, 1024) # Default value
         self.auto_generating = False
         self.auto_saving = False
+        self.cache_budget = 512 * 1024 * 1024 # Default value (in bytes)
+        self.sampling_chunk = 65536 # Number of rows sampled at once by sample_batch
+        self.unique = False
+        self.unique_attempts = 1000 # Number of resampling attempts before giving up
+        self.output_counters = {}
+        self.encoder = 'png' # Default value
+        self.metadata_format = None # None, 'jsonl' or 'csv'
+        self.metadata_writers = {}
+        self.checkpoint_interval = 100 # Number of saved images between checkpoints of generating run
+        self.collection_seed = None # When set, image number i is always generated from the same seed
+        self.next_token = 0
+        self.state_lock = threading.Lock() # Guards next_token and creating seen_combinations
+        self.metadata_lock = threading.Lock() # Guards creating metadata writers
+        self.layer_cache = LayerCache(self.cache_budget)
+        self.prefix_depth = 2 # Number of bottom layers whose composites are reused
+        self.prefix_cache_budget = 256 * 1024 * 1024 # Default value (in bytes)
+        self.prefix_cache = LayerCache(self.prefix_cache_budget)
+        self.preview_size = None # When set, images which are only displayed can be composed at this size
+        self.preview_cache_budget = 128 * 1024 * 1024 # Default value (in bytes)
+        self.preview_cache = LayerCache(self.preview_cache_budget)
+        self.asset_pack_path = None
+        self.asset_pack = None
+        self.asset_pack_index = None
+        self.manifest_path = None # When set, results of scanning components are reused between reloads
+        self.manifest = None
+        self.asset_problems = {'converted': [], 'resized': [], 'unreadable': []}
+        self.timings = StageTimings() # Durations of fetching, generating and saving stages
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['current_image'] = None # No need to send last image to worker processes
+        state['output_counters'] = {}
+        state['metadata_writers'] = {}
+        state['manifest'] = None
+        state['asset_pack'] = None # Every process maps asset pack on its own, pages are shared by the system
+        state['current_result'] = None
+        del state['state_lock']
+        del state['metadata_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.state_lock = threading.Lock()
+        self.metadata_lock = threading.Lock()
 
     def get_absolute_path(self, path):
         return self.components_path + '/' + path
@@ -27,12 +618,93 @@ class Mixer:
         self.skipped_data = {}
         self.current_image = None
         self.current_traits = {}
+        self.current_preview = False
+        self.current_result = None
+        self.layer_cache = LayerCache(self.cache_budget)
+        self.prefix_cache = LayerCache(self.prefix_cache_budget)
+        self.preview_cache = LayerCache(self.preview_cache_budget)
+        self.asset_pack_path = None
+        self.asset_pack = None
+        self.asset_pack_index = None
+        self.asset_problems = {'converted': [], 'resized': [], 'unreadable': []}
 
+        start = self.timings.start()
+        self.load_manifest()
         self.load_layers_order()
         self.load_exceptions_file()
         self.load_components_directory()
+        start = self.timings.add('fetch_scan', start)
         self.load_rarity_files()
         self.get_image_size()
+        self.save_manifest()
+        self.timings.add('fetch_rarity', start)
+
+    def load_manifest(self):
+        self.manifest = None
+        self.manifest_changed = False
+        if not self.manifest_path:
+            return
+
+        try:
+            with open(self.manifest_path, 'r') as file:
+                self.manifest = json.loads(file.read())
+        except:
+            pass
+
+        if not self.manifest or self.manifest.get('components_path') != self.components_path:
+            self.manifest = {'components_path': self.components_path, 'directories': {}, 'files': {}, 'image_size': None, 'assets': {}}
+            self.manifest_changed = True
+
+    def save_manifest(self):
+        if self.manifest is None or not self.manifest_changed:
+            return
+
+        try:
+            with open(self.manifest_path + '.tmp', 'w') as file:
+                file.write(json.dumps(self.manifest))
+            os.replace(self.manifest_path + '.tmp', self.manifest_path)
+            self.manifest_changed = False
+        except:
+            pass
+
+    def scan_layer_directory(self, directory):
+        # Returns PNG files of given directory, rescanning it only if its modification time changed
+        mtime = directory.stat().st_mtime_ns if self.manifest is not None else None
+        if mtime is not None:
+            entry = self.manifest['directories'].get(directory.path)
+            if entry and entry['mtime'] == mtime:
+                return entry['files']
+
+        files = []
+        with os.scandir(directory.path) as scan:
+            for file in scan:
+                if file.is_file() and file.name.split('.')[-1].lower() == 'png':
+                    files.append(file.name)
+
+        if mtime is not None:
+            self.manifest['directories'][directory.path] = {'mtime': mtime, 'files': files}
+            self.manifest_changed = True
+
+        return files
+
+    def read_json_file(self, path):
+        # Returns parsed content of JSON file, reusing manifest entry if file didn't change
+        stat = os.stat(path) if self.manifest is not None else None
+        if stat:
+            entry = self.manifest['files'].get(path)
+            if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+                return entry['data']
+
+        with open(path, 'r') as file:
+            data = file.read()
+        data = data.replace('\t', '')
+        data = json.loads(data)
+
+        if stat:
+            self.manifest['files'][path] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'data': data}
+            self.manifest_changed = True
+
+        return data
 
     def load_components_directory(self):
         self.total_images = 0
@@ -42,15 +714,13 @@ class Mixer:
             with os.scandir(self.components_path) as scan:
                 for file in scan:
                     if file.is_dir():
-                        with os.scandir(file.path) as subscan:
-                            for subfile in subscan:
-                                if subfile.is_file() and subfile.name.split('.')[-1].lower() == 'png':
-                                    if file.name in self.data:
-                                        self.data[file.name].append(subfile.name)
-                                        self.total_images += 1
-                                    else:
-                                        self.skipped_data[file.name].append(subfile.name)
-                                        self.skipped_total_images += 1
+                        for subfile in self.scan_layer_directory(file):
+                            if file.name in self.data:
+                                self.data[file.name].append(subfile)
+                                self.total_images += 1
+                            else:
+                                self.skipped_data[file.name].append(subfile)
+                                self.skipped_total_images += 1
 
                         if file.name in self.data and self.data[file.name]:
                             self.possible_combinations *= len(self.data[file.name])
@@ -90,15 +760,30 @@ class Mixer:
 
     def load_exceptions_file(self):
         self.exception_list = None
+        self.blocked_items = {}
+        self.blocked_layers = {}
         try:
-            with open(self.exceptions_path, 'r') as file:
-                data = file.read()
-
-            data = data.replace('\t', '')
-            self.exception_list = json.loads(data)
+            self.exception_list = self.read_json_file(self.exceptions_path)
+            self.compile_exceptions()
 
         except:
-            pass
+            self.exception_list = None
+            self.blocked_items = {}
+            self.blocked_layers = {}
+
+    def compile_exceptions(self):
+        # Every item points to all items and layers that can't appear alongside it:
+        blocked_items = {}
+        blocked_layers = {}
+        for rule in self.exception_list:
+            items = {e for e in rule if e[-1] != '/'}
+            layers = {e[:-1] for e in rule if e[-1] == '/'}
+            for exception in items:
+                blocked_items.setdefault(exception, set()).update(items)
+                blocked_layers.setdefault(exception, set()).update(layers)
+
+        self.blocked_items = {item: frozenset(blocked_items[item]) for item in blocked_items}
+        self.blocked_layers = {item: frozenset(blocked_layers[item]) for item in blocked_layers if blocked_layers[item]}
 
     def load_rarity_files(self):
         self.rarity_levels = {}
@@ -107,10 +792,7 @@ class Mixer:
             path = self.get_absolute_path(directory) + '/' + self.rarity_filename
             if os.path.isfile(path):
                 try:
-                    with open(path, 'r') as file:
-                        data = file.read()
-                    data = data.replace('\t', '')
-                    data = json.loads(data)
+                    data = self.read_json_file(path)
 
                     self.max_rarity_level = 0
                     for level in data:
@@ -126,6 +808,312 @@ class Mixer:
         if not self.rarity_levels:
             self.max_rarity_level = 1
 
+        self.build_samplers()
+
+    def build_samplers(self):
+        self.samplers = {}
+        for directory in self.data:
+            items = self.data[directory]
+            weights = [self.rarity_levels.get('.'.join(item.split('.')[:-1]), self.max_rarity_level) for item in items]
+            self.samplers[directory] = LayerSampler(items, weights)
+
+        self.exception_masks = None
+        self.seen_combinations = None
+        self.possible_combinations_exact = False
+        self.effective_combinations = None
+        self.combinations_counted = False
+        self.trait_probabilities = None
+        self.trait_probabilities_exact = False
+
+    def get_seen_combinations(self):
+        with self.state_lock:
+            if self.seen_combinations is None:
+                self.seen_combinations = UniqueCombinations([len(sampler.items) + 1 for sampler in self.samplers.values()])
+
+        return self.seen_combinations
+
+    def save_seen_combinations(self, path):
+        self.get_seen_combinations().save(path)
+
+    def load_seen_combinations(self, path):
+        self.get_seen_combinations().load(path)
+
+    def count_possible_combinations(self):
+        # Not done while fetching data, as it can take a while with many exception rules and only dashboard shows it
+        start = self.timings.start()
+        self.possible_combinations_exact = False
+        self.effective_combinations = None
+        if self.total_images:
+            result = self.count_combinations(weighted=True)
+            if result is not None:
+                self.possible_combinations, collision = result
+                self.possible_combinations_exact = True
+                self.effective_combinations = 1 / collision if collision else 0
+            else:
+                self.possible_combinations = round(self.estimate_combinations())
+
+        self.combinations_counted = True
+        self.timings.add('count_combinations', start)
+
+    def estimate_combinations(self, samples=100000, rng=None):
+        # Knuth's estimator: every item is chosen uniformly among allowed ones and every path
+        # is weighted by inverse of its probability, which on average gives number of combinations.
+        rng = rng or np.random.default_rng()
+        masks = self.get_exception_masks()
+        samplers = list(self.samplers.values())
+        estimate = 0.0
+
+        for start in range(0, samples, self.sampling_chunk):
+            stop = min(samples, start + self.sampling_chunk)
+            rows = stop - start
+            paths = np.ones(rows, dtype=np.float64)
+            pending = [[] for _ in samplers]
+            for k, sampler in enumerate(samplers):
+                positive = (sampler.weights_array > 0).astype(np.float64)
+                cum_positive = np.cumsum(positive)
+                u = rng.random(rows)
+                counts = np.full(rows, positive.sum())
+                column = np.searchsorted(cum_positive, np.floor(u * counts), side='right')
+
+                blocked_rows, blocked_columns, skip = self.get_batch_restrictions(pending[k], len(sampler.items))
+                if len(blocked_rows):
+                    # Uniform choice among allowed items is weighted choice with weights 0 and 1
+                    affected, indices, totals = draw_restricted(positive, cum_positive, u, blocked_rows, blocked_columns)
+                    counts[affected] = totals
+                    column[affected] = indices
+                if skip is not None:
+                    counts[skip] = 0
+
+                column[counts == 0] = -1
+                self.add_batch_restrictions(masks[k], column, pending)
+                paths *= np.maximum(counts, 1)
+
+            estimate += paths.sum()
+
+        return estimate / samples if samples else 0.0
+
+    def get_layer_effects(self):
+        # Names and layers which can still be affected after every position:
+        samplers = list(self.samplers.items())
+        layers = len(samplers)
+        future_names = [frozenset()] * (layers + 1)
+        future_layers = [frozenset()] * (layers + 1)
+        for k in reversed(range(layers)):
+            future_names[k] = future_names[k + 1] | samplers[k][1].name_set
+            future_layers[k] = future_layers[k + 1] | {samplers[k][0]}
+
+        def get_effect(k, trait):
+            return (self.blocked_items.get(trait, frozenset()) & future_names[k + 1], self.blocked_layers.get(trait, frozenset()) & future_layers[k + 1])
+
+        # Effect of every item (that can be chosen at all) on next layers, items with the same effect can be grouped:
+        effects = []
+        for k, (directory, sampler) in enumerate(samplers):
+            effects.append({
+                'none': get_effect(k, 'none'),
+                'items': [(i, get_effect(k, sampler.names[i])) for i in range(len(sampler.items)) if sampler.weights[i] > 0]
+            })
+
+        return future_names, future_layers, effects
+
+    def get_layer_groups(self):
+        # Layers split into groups which no exception rule connects, combinations of every group are independent of the others
+        samplers = list(self.samplers.items())
+        _, _, effects = self.get_layer_effects()
+        name_layers = {}
+        for k, (_, sampler) in enumerate(samplers):
+            for name in sampler.names:
+                name_layers.setdefault(name, []).append(k)
+        layer_positions = {directory: k for k, (directory, _) in enumerate(samplers)}
+
+        parents = list(range(len(samplers)))
+        def find(k):
+            while parents[k] != k:
+                parents[k] = parents[parents[k]]
+                k = parents[k]
+            return k
+
+        for k in range(len(samplers)):
+            for items, layers in {effects[k]['none']} | {effect for _, effect in effects[k]['items']}:
+                for other in [l for name in items for l in name_layers[name]] + [layer_positions[directory] for directory in layers]:
+                    parents[find(other)] = find(k)
+
+        groups = {}
+        for k in range(len(samplers)):
+            groups.setdefault(find(k), []).append(k)
+
+        return list(groups.values())
+
+    def compute_trait_probabilities(self):
+        # Like counting combinations, only done when dashboard or 'probabilities' command needs it
+        start = self.timings.start()
+        self.trait_probabilities = None
+        self.trait_probabilities_exact = False
+        if self.total_images:
+            self.trait_probabilities = self.get_trait_probabilities()
+            if self.trait_probabilities is not None:
+                self.trait_probabilities_exact = True
+            else:
+                self.trait_probabilities = self.estimate_trait_probabilities()
+
+        self.timings.add('trait_probabilities', start)
+
+    def get_trait_probabilities(self):
+        # Exact probability of every trait (and 'none') in every layer, honouring weights and exception rules.
+        # Returns None if the number of distinct exception states exceeds counting_state_limit.
+        samplers = list(self.samplers.items())
+        future_names, future_layers, effects = self.get_layer_effects()
+        visited = 0
+        result = {}
+
+        # Groups of layers which exception rules don't connect are independent, so every group starts from empty state
+        groups = self.get_layer_groups()
+        order = [k for group in groups for k in group]
+        starts = {group[0] for group in groups}
+        for k in order:
+            directory, sampler = samplers[k]
+            if k in starts:
+                states = {(frozenset(), frozenset()): 1.0}
+                visited = 0
+            probabilities = [0.0] * len(sampler.items)
+            none = 0.0
+            next_states = {}
+            for (blocked_items, blocked_layers), p in states.items():
+                allowed = []
+                if not directory in blocked_layers:
+                    allowed = [(i, effect) for i, effect in effects[k]['items'] if not sampler.names[i] in blocked_items]
+
+                transitions = {}
+                total = sum(sampler.weights[i] for i, _ in allowed)
+                if total > 0:
+                    for i, effect in allowed:
+                        q = p * sampler.weights[i] / total
+                        probabilities[i] += q
+                        transitions[effect] = transitions.get(effect, 0.0) + q
+                else:
+                    none += p
+                    transitions[effects[k]['none']] = p
+
+                for (items, layers), q in transitions.items():
+                    state = ((blocked_items | items) & future_names[k + 1], (blocked_layers | layers) & future_layers[k + 1])
+                    next_states[state] = next_states.get(state, 0.0) + q
+
+            visited += len(next_states)
+            if visited > self.counting_state_limit:
+                return None
+
+            states = next_states
+            result[directory] = {sampler.names[i]: probabilities[i] for i in range(len(sampler.items))}
+            result[directory]['none'] = none
+
+        return {directory: result[directory] for directory, _ in samplers}
+
+    def estimate_trait_probabilities(self, samples=200000, rng=None):
+        # Monte Carlo version of get_trait_probabilities for very large configurations
+        indices = self.sample_batch(samples, rng)
+        result = {}
+        for k, (directory, sampler) in enumerate(self.samplers.items()):
+            counts = np.bincount(indices[:, k] + 1, minlength=len(sampler.items) + 1) / max(samples, 1)
+            result[directory] = {sampler.names[i]: float(counts[i + 1]) for i in range(len(sampler.items))}
+            result[directory]['none'] = float(counts[0])
+
+        return result
+
+    def count_combinations(self, weighted=False):
+        # Exact number of combinations that generate() can produce, honouring exception rules.
+        # With weighted=True also returns sum of squared probabilities of all combinations.
+        # Returns None if the number of distinct exception states exceeds counting_state_limit.
+        samplers = list(self.samplers.items())
+        layers = len(samplers)
+        future_names, future_layers, effects = self.get_layer_effects()
+
+        memo = {}
+        def count(order, position, blocked_items, blocked_layers):
+            if position == len(order):
+                return 1, 1.0
+
+            k = order[position]
+            state = (k, blocked_items, blocked_layers)
+            if state in memo:
+                return memo[state]
+            if len(memo) >= self.counting_state_limit:
+                raise OverflowError
+
+            directory, sampler = samplers[k]
+            groups = {}
+            total = 0
+            if not directory in blocked_layers:
+                for i, effect in effects[k]['items']:
+                    if not sampler.names[i] in blocked_items:
+                        group = groups.setdefault(effect, [0, 0])
+                        group[0] += 1
+                        group[1] += sampler.weights[i] ** 2
+                        total += sampler.weights[i]
+
+            if not groups:
+                groups = {effects[k]['none']: [1, 1]}
+                total = 1
+
+            combinations = 0
+            collision = 0.0
+            for (items, layers_), (n, weights) in groups.items():
+                next_count, next_collision = count(order, position + 1, (blocked_items | items) & future_names[k + 1], (blocked_layers | layers_) & future_layers[k + 1])
+                combinations += n * next_count
+                collision += weights / total ** 2 * next_collision
+
+            memo[state] = combinations, collision
+            return memo[state]
+
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, 2 * layers + 100))
+        try:
+            # Groups of layers are counted separately, so their states are never multiplied together
+            combinations, collision = 1, 1.0
+            for order in self.get_layer_groups():
+                memo.clear()
+                group_combinations, group_collision = count(order, 0, frozenset(), frozenset())
+                combinations *= group_combinations
+                collision *= group_collision
+        except OverflowError:
+            return None
+        finally:
+            sys.setrecursionlimit(limit)
+
+        return (combinations, collision) if weighted else combinations
+
+    def get_exception_masks(self):
+        # For every layer: None if its items don't affect later layers, otherwise (blocking, offsets, layers, columns).
+        # Items are indexed as chosen by sampling, the last one (-1) stands for 'none'. Item a blocks items
+        # columns[offsets[a]:offsets[a + 1]] of later layers layers[offsets[a]:offsets[a + 1]], column -1 means the whole layer.
+        # Blocking vector tells which of the items affect anything.
+        if self.exception_masks is not None:
+            return self.exception_masks
+
+        samplers = list(self.samplers.items())
+        positions = [{name: i for i, name in enumerate(sampler.names)} for _, sampler in samplers]
+        self.exception_masks = []
+        for j, (_, sampler) in enumerate(samplers):
+            effects = []
+            for trait in sampler.names + ('none',):
+                pairs = []
+                for k in range(j + 1, len(samplers)):
+                    if samplers[k][0] in self.blocked_layers.get(trait, ()):
+                        pairs.append((k, -1))
+                    else:
+                        pairs.extend((k, column) for column in sorted(positions[k][name] for name in self.blocked_items.get(trait, ()) if name in positions[k]))
+                effects.append(pairs)
+
+            blocking = np.array([len(pairs) > 0 for pairs in effects], dtype=bool)
+            if not blocking.any():
+                self.exception_masks.append(None)
+                continue
+            offsets = np.zeros(len(effects) + 1, dtype=np.intp)
+            offsets[1:] = np.cumsum([len(pairs) for pairs in effects])
+            layers = np.array([k for pairs in effects for k, _ in pairs], dtype=np.int16) # Small integers are sorted faster
+            columns = np.array([column for pairs in effects for _, column in pairs], dtype=np.intp)
+            self.exception_masks.append((blocking, offsets, layers, columns))
+
+        return self.exception_masks
+
     def get_image_size(self):
         image = None
         for directory in self.data:
@@ -134,54 +1122,480 @@ class Mixer:
                 break
 
         if image:
-            image = Image.open(self.get_absolute_path(f'{directory}/{image}'))
-            self.image_size = image.size
-            return image.size
+            path = self.get_absolute_path(f'{directory}/{image}')
+            mtime = os.stat(path).st_mtime_ns if self.manifest is not None else None
+            entry = self.manifest['image_size'] if mtime is not None else None
+            if entry and entry['path'] == path and entry['mtime'] == mtime:
+                self.image_size = tuple(entry['size'])
+                return self.image_size
+
+            with Image.open(path) as file:
+                self.image_size = file.size
+
+            if mtime is not None:
+                self.manifest['image_size'] = {'path': path, 'mtime': mtime, 'size': list(self.image_size)}
+                self.manifest_changed = True
+
+            return self.image_size
+
+    def get_layer(self, directory, item):
+        # Returns layer cropped to its visible area and position of that area (None if layer is fully transparent)
+        key = (directory, item)
+        layer = self.layer_cache.get(key)
+        if layer is None and self.asset_pack_path:
+            layer = self.get_packed_layer(directory, item)
+            self.layer_cache.put(key, layer, 0) # Pixels live in mapped file, not in memory of this process
+
+        elif layer is None:
+            start = self.timings.start()
+            with Image.open(self.get_absolute_path(f'{directory}/{item}')) as file:
+                image = file.convert('RGBA') if file.mode != 'RGBA' else file.copy()
+            if image.size != self.image_size:
+                image = image.resize(self.image_size, Image.LANCZOS)
+
+            bbox = image.getchannel('A').getbbox()
+            if bbox is None:
+                layer = (None, None)
+            elif bbox == (0, 0, *image.size):
+                layer = (image, (0, 0))
+            else:
+                layer = (image.crop(bbox), bbox[:2])
+
+            self.layer_cache.put(key, layer, layer[0].width * layer[0].height * 4 if layer[0] else 0)
+            self.timings.add('decode', start)
+
+        return layer
+
+    def set_preview_size(self, size):
+        # Scale is rounded up to 1/16, so resizing window doesn't scale layers again for every pixel
+        scale = max(size[0] / self.image_size[0], size[1] / self.image_size[1]) if size else 1
+        steps = max(1, int(-(-scale * 16 // 1)))
+        if steps >= 16:
+            self.preview_size = None
+        else:
+            self.preview_size = (max(1, self.image_size[0] * steps // 16), max(1, self.image_size[1] * steps // 16))
+
+    def get_preview_layer(self, directory, item, size):
+        # Layer scaled down to given image size, with its position scaled accordingly
+        key = (directory, item, size)
+        layer = self.preview_cache.get(key)
+        if layer is None:
+            image, offset = self.get_layer(directory, item)
+            if image is None:
+                layer = (None, None)
+            else:
+                scale_x = size[0] / self.image_size[0]
+                scale_y = size[1] / self.image_size[1]
+                left, top = round(offset[0] * scale_x), round(offset[1] * scale_y)
+                right, bottom = round((offset[0] + image.width) * scale_x), round((offset[1] + image.height) * scale_y)
+                if right <= left or bottom <= top:
+                    layer = (None, None)
+                else:
+                    layer = (image.resize((right - left, bottom - top), Image.BILINEAR, reducing_gap=2.0), (left, top))
+
+            self.preview_cache.put(key, layer, layer[0].width * layer[0].height * 4 if layer[0] else 0)
+
+        return layer
+
+    def validate_assets(self, workers=None):
+        # Checks mode and size of every layer and decodes it into the cache, so broken files are found before generating.
+        # With manifest, results are stored there and only changed files are checked again.
+        # Unreadable layers are excluded from generating.
+        assets = self.manifest.setdefault('assets', {}) if self.manifest is not None else None
+        def check(task):
+            directory, item = task
+            path = self.get_absolute_path(f'{directory}/{item}')
+            try:
+                stat = os.stat(path) if assets is not None else None
+            except:
+                return task, None, None, None
+            if stat:
+                entry = assets.get(path)
+                if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+                    return task, entry['mode'], tuple(entry['dimensions']) if entry['dimensions'] else None, None
+
+            try:
+                with Image.open(path) as file:
+                    mode, size = file.mode, file.size
+                self.get_layer(directory, item) # Decoded layer is kept in the cache for generating
+            except:
+                mode, size = None, None
+            entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'mode': mode, 'dimensions': list(size) if size else None} if stat else None
+            return task, mode, size, entry
+
+        tasks = [(directory, item) for directory in self.data for item in self.data[directory]]
+        with ThreadPoolExecutor(workers or min(32, (os.cpu_count() or 1) + 4)) as executor:
+            results = list(executor.map(check, tasks))
+
+        self.asset_problems = {'converted': [], 'resized': [], 'unreadable': []}
+        unreadable = set()
+        for (directory, item), mode, size, entry in results:
+            name = f'{directory}/{item}'
+            if entry:
+                assets[self.get_absolute_path(name)] = entry
+                self.manifest_changed = True
+            if mode is None:
+                self.asset_problems['unreadable'].append(name)
+                unreadable.add((directory, item))
+                continue
+            if mode != 'RGBA':
+                self.asset_problems['converted'].append(name)
+            if size != self.image_size:
+                self.asset_problems['resized'].append(name)
+
+        if unreadable:
+            for directory in self.data:
+                self.data[directory] = [item for item in self.data[directory] if not (directory, item) in unreadable]
+            self.total_images -= len(unreadable)
+            self.build_samplers()
+
+        self.save_manifest()
+        return self.asset_problems
+
+    def get_packed_layer(self, directory, item):
+        if self.asset_pack is None:
+            self.open_asset_pack()
+
+        entry = self.asset_pack_index[directory][item]
+        if entry is None:
+            return (None, None)
+
+        offset, width, height, x, y = entry
+        buffer = memoryview(self.asset_pack)[offset:offset + width * height * 4]
+        return (Image.frombuffer('RGBA', (width, height), buffer, 'raw', 'RGBA', 0, 1), (x, y))
+
+    def build_asset_pack(self, path):
+        # Writes all decoded layers together with loaded configuration into a single file
+        index = {}
+        with open(path + '.tmp', 'wb') as file:
+            file.write(b'\0' * ASSET_PACK_ALIGNMENT)
+            for directory in self.data:
+                index[directory] = {}
+                for item in self.data[directory]:
+                    layer, offset = self.get_layer(directory, item)
+                    if layer is None:
+                        index[directory][item] = None
+                        continue
+
+                    position = file.tell()
+                    file.write(layer.tobytes('raw', 'RGBA'))
+                    file.write(b'\0' * (-file.tell() % ASSET_PACK_ALIGNMENT))
+                    index[directory][item] = [position, layer.width, layer.height, *offset]
+
+            header = json.dumps({
+                'image_size': list(self.image_size),
+                'data': self.data,
+                'skipped_data': self.skipped_data,
+                'total_images': self.total_images,
+                'skipped_total_images': self.skipped_total_images,
+                'exception_list': self.exception_list,
+                'rarity_levels': self.rarity_levels,
+                'max_rarity_level': self.max_rarity_level,
+                'rarity_files': self.rarity_files,
+                'layers': index
+            }).encode('utf-8')
+            header_offset = file.tell()
+            file.write(header)
+            file.seek(0)
+            file.write(ASSET_PACK_PREAMBLE.pack(ASSET_PACK_MAGIC, header_offset, len(header)))
+
+        os.replace(path + '.tmp', path)
+
+    def open_asset_pack(self):
+        try:
+            with open(self.asset_pack_path, 'rb') as file:
+                pack = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+            magic, header_offset, header_length = ASSET_PACK_PREAMBLE.unpack(pack[:ASSET_PACK_PREAMBLE.size])
+            if magic != ASSET_PACK_MAGIC:
+                raise AssetPackError
+            header = json.loads(pack[header_offset:header_offset + header_length].decode('utf-8'))
+        except AssetPackError:
+            raise
+        except:
+            raise AssetPackError
+
+        self.asset_pack = pack
+        self.asset_pack_index = header['layers']
+        return header
 
-    def generate(self):
+    def load_asset_pack(self, path):
+        # Replacement for fetch_data which doesn't touch components directory at all
+        self.asset_pack_path = path
+        self.asset_pack = None
+        header = self.open_asset_pack()
+
+        self.current_image = None
         self.current_traits = {}
-        image = Image.new('RGBA', self.image_size, (0,0,0,0))
+        self.current_preview = False
+        self.current_result = None
+        self.layer_cache = LayerCache(self.cache_budget)
+        self.prefix_cache = LayerCache(self.prefix_cache_budget)
+        self.preview_cache = LayerCache(self.preview_cache_budget)
+        self.image_size = tuple(header['image_size'])
+        self.data = header['data']
+        self.skipped_data = header['skipped_data']
+        self.total_images = header['total_images']
+        self.skipped_total_images = header['skipped_total_images']
+        self.rarity_levels = header['rarity_levels']
+        self.max_rarity_level = header['max_rarity_level']
+        self.rarity_files = header['rarity_files']
+        self.exception_list = header['exception_list']
+        self.blocked_items = {}
+        self.blocked_layers = {}
+        if self.exception_list:
+            self.compile_exceptions()
 
+        self.possible_combinations = 1
         for directory in self.data:
-            skip = False
-            cleared_items = [*self.data[directory]]
-
-            # Exclude disallowed combinations:
-            if self.exception_list:
-                for trait in self.current_traits:
-                    for rule in self.exception_list:
-                        for exception in rule:
-                            if self.current_traits[trait] == exception:
-                                for e in rule:
-                                    if e[-1] == '/' and e[:-1] == directory:
-                                        skip = True
-                                        break
-                                    if e + '.png' in cleared_items:
-                                        cleared_items.remove(e + '.png')
-
-            if not skip and cleared_items:
-                weighted_items = {}
-                for item in cleared_items:
-                    weighted_items[item] = self.rarity_levels.get('.'.join(item.split('.')[:-1]), self.max_rarity_level)
-
-                item = random.choices(list(weighted_items.keys()), list(weighted_items.values()), k=1)[0]
-
-                layer = Image.open(self.get_absolute_path(f'{directory}/{item}'))
-                image = Image.alpha_composite(image, layer)
-                self.current_traits[directory] = '.'.join(item.split('.')[:-1])
+            if self.data[directory]:
+                self.possible_combinations *= len(self.data[directory])
 
-            else:
-                self.current_traits[directory] = 'none'
+        self.build_samplers()
+
+    def preload_layers(self):
+        for directory in self.data:
+            for item in self.data[directory]:
+                if self.layer_cache.size >= self.layer_cache.budget:
+                    return
+                self.get_layer(directory, item)
+
+    def sample_indices(self, rng):
+        # Returns index of the chosen item for every layer (-1 means 'none')
+        indices = []
+        blocked_items = set()
+        blocked_layers = set()
+
+        for directory in self.samplers:
+            sampler = self.samplers[directory]
+            u = rng.random() # Drawn for every layer, so n-th number always belongs to the same layer
+            index = None
+            if not directory in blocked_layers:
+                index = sampler.draw(u, blocked_items)
+
+            trait = sampler.names[index] if index is not None else 'none'
+            if trait in self.blocked_items:
+                blocked_items |= self.blocked_items[trait]
+            if trait in self.blocked_layers:
+                blocked_layers |= self.blocked_layers[trait]
+
+            indices.append(index if index is not None else -1)
+
+        return indices
+
+    def sample_batch(self, n, rng=None, keys=None, attempts=None):
+        # Draws traits for n images at once, returns matrix with one column per layer (-1 means 'none').
+        # With keys, numbers are the same as TokenRandom of every key would give (after given number of attempts).
+        rng = rng or np.random.default_rng()
+        if keys is not None and attempts is None:
+            attempts = np.zeros(n, dtype=np.uint64)
+        masks = self.get_exception_masks()
+        samplers = list(self.samplers.values())
+        result = np.empty((len(samplers), n), dtype=np.int32) # One row per layer, so every layer is contiguous
+
+        for start in range(0, n, self.sampling_chunk):
+            stop = min(n, start + self.sampling_chunk)
+            rows = stop - start
+            pending = [[] for _ in samplers] # Restrictions added by items chosen in earlier layers
+            for k, sampler in enumerate(samplers):
+                column = result[k, start:stop]
+                if keys is not None:
+                    u = get_uniforms(keys[start:stop], attempts[start:stop] * len(samplers) + k)
+                else:
+                    u = rng.random(rows)
+
+                if sampler.total <= 0:
+                    column[:] = -1
+                else:
+                    column[:] = sampler.draw_batch(u)
+                    blocked_rows, blocked_columns, skip = self.get_batch_restrictions(pending[k], len(sampler.items))
+                    if len(blocked_rows):
+                        # Same as LayerSampler.draw: blocked items get zero weight and the rest is re-normalised
+                        affected, indices, _ = sampler.draw_restricted(u, blocked_rows, blocked_columns)
+                        column[affected] = indices
+                    if skip is not None:
+                        column[skip] = -1
+
+                self.add_batch_restrictions(masks[k], column, pending)
+
+        return np.ascontiguousarray(result.T)
+
+    def add_batch_restrictions(self, mask, column, pending):
+        # Adds (rows, columns) blocked by items chosen in the column to pending restrictions of later layers
+        if mask is None:
+            return
+        blocking, offsets, layers, columns = mask
+        hit = np.flatnonzero(blocking[column]) # 'none' (-1) is the last item
+        if not len(hit):
+            return
+
+        chosen = column[hit].astype(np.intp)
+        chosen[chosen < 0] = len(blocking) - 1
+        starts = offsets[chosen]
+        counts = offsets[chosen + 1] - starts
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - starts, counts)
+        rows = np.repeat(hit, counts)
+        targets = layers[positions]
+        order = np.argsort(targets, kind='stable')
+        targets, firsts = np.unique(targets[order], return_index=True)
+        for k, target_rows, target_columns in zip(targets, np.split(rows[order], firsts[1:]), np.split(columns[positions][order], firsts[1:])):
+            pending[k].append((target_rows, target_columns))
+
+    def get_batch_restrictions(self, pending, items):
+        # Returns blocked (row, column) pairs sorted by row and column and rows skipping the layer (None if there are none)
+        if not pending:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), None
+        rows = np.concatenate([rows for rows, _ in pending])
+        columns = np.concatenate([columns for _, columns in pending])
+
+        skipped = columns < 0
+        skip = rows[skipped] if skipped.any() else None
+        keys = rows[~skipped] * items + columns[~skipped]
+
+        # The same item can be blocked by several earlier layers
+        keys.sort()
+        if len(keys):
+            keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+        return keys // items, keys % items, skip
 
-        self.current_image = image
+    def get_traits(self, indices):
+        traits = {}
+        for directory, index in zip(self.samplers, indices):
+            traits[directory] = self.samplers[directory].names[index] if index >= 0 else 'none'
+
+        return traits
+
+    def compose(self, indices):
+        # Composites of first few layers are cached, so images sharing bottom traits skip these blends
+        depth = min(self.prefix_depth, len(indices) - 1)
+        start = 0
+        image = None
+        for d in range(depth, 0, -1):
+            cached = self.prefix_cache.get(tuple(indices[:d]))
+            if cached is not None:
+                image = cached.copy()
+                start = d
+                break
+
+        if image is None:
+            image = Image.new('RGBA', self.image_size, (0,0,0,0))
+
+        for position, (directory, index) in enumerate(zip(self.samplers, indices)):
+            if position < start:
+                continue
+
+            if index >= 0:
+                layer, offset = self.get_layer(directory, self.samplers[directory].items[index])
+                if layer is not None:
+                    image.alpha_composite(layer, offset) # Blends only the area covered by the layer
+
+            if position < depth:
+                self.prefix_cache.put(tuple(indices[:position + 1]), image.copy(), image.width * image.height * 4)
 
         return image
 
-    def save(self, path):
+    def compose_preview(self, indices, size):
+        image = Image.new('RGBA', size, (0,0,0,0))
+        for directory, index in zip(self.samplers, indices):
+            if index >= 0:
+                layer, offset = self.get_preview_layer(directory, self.samplers[directory].items[index], size)
+                if layer is not None:
+                    image.alpha_composite(layer, offset)
+
+        return image
+
+    def sample_unique_indices(self, rng):
+        seen = self.get_seen_combinations()
+        for _ in range(self.unique_attempts):
+            indices = self.sample_indices(rng)
+            if seen.add(indices):
+                return indices
+
+        raise CombinationsExhaustedError
+
+    def sample_unique_batch(self, n, rng=None, keys=None):
+        # Rows are checked in order and a rejected row is drawn again with its next numbers before the next row is checked,
+        # so with keys the result is the same as sample_unique_indices of every key in turn would give
+        rng = rng or np.random.default_rng()
+        seen = self.get_seen_combinations()
+        rows = self.sample_batch(n, keys=keys) if keys is not None else self.sample_batch(n, rng)
+        result = np.empty((n, len(self.samplers)), dtype=np.int32)
+        for position, indices in enumerate(rows.tolist()):
+            attempt = 0
+            retries = []
+            while not seen.add(indices):
+                attempt += 1
+                if attempt >= self.unique_attempts:
+                    raise CombinationsExhaustedError
+                if not retries:
+                    # Next attempts of the row are drawn together
+                    count = min(self.unique_attempts - attempt, 64)
+                    if keys is not None:
+                        retries = self.sample_batch(count, keys=np.full(count, keys[position], dtype=np.uint64), attempts=np.arange(attempt, attempt + count, dtype=np.uint64))
+                    else:
+                        retries = self.sample_batch(count, rng)
+                    retries = retries.tolist()[::-1]
+                indices = retries.pop()
+            result[position] = indices
+
+        return result
+
+    def get_seed(self, token=None):
+        # Image is fully determined by its seed. With collection_seed set, seed of token i is derived from (collection_seed, i).
+        if self.collection_seed is None:
+            return random.getrandbits(64)
+
+        with self.state_lock:
+            token = self.next_token if token is None else token
+            self.next_token = token + 1
+        return get_token_key(self.collection_seed, token)
+
+    def create_image(self, rng, seed=None, preview_size=None):
+        # Doesn't change the mixer, only reads loaded data and thread-safe caches, so it can run in many threads at once
+        first = start = self.timings.start()
+        indices = self.sample_unique_indices(rng) if self.unique else self.sample_indices(rng)
+        traits = self.get_traits(indices)
+        start = self.timings.add('sample', start) # Includes exception rules and uniqueness checks
+
+        # Images which are only displayed are composed at preview size, full size is rendered when saving
+        image = self.compose_preview(indices, preview_size) if preview_size else self.compose(indices)
+        self.timings.add('compose', start) # Includes decoding of layers which weren't cached yet
+        self.timings.add('generate', first)
+
+        return GeneratedImage(image, traits, seed, indices, bool(preview_size))
+
+    def generate_image(self, token=None, seed=None, preview=False):
+        seed = self.get_seed(token) if seed is None else seed
+        return self.create_image(TokenRandom(seed), seed, self.preview_size if preview else None)
+
+    def generate(self, token=None, seed=None, preview=False):
+        # Generated image becomes the current one, which is saved by save()
+        result = self.generate_image(token, seed, preview)
+        self.current_result = result
+        self.current_seed = result.seed
+        self.current_indices = result.indices
+        self.current_traits = result.traits
+        self.current_preview = result.preview
+        self.current_image = result.image
+
+        return self.current_image
+
+    def get_full_image(self, result=None):
+        if result is not None:
+            return self.compose(result.indices) if result.preview else result.image
+
+        if self.current_preview:
+            self.current_image = self.compose(self.current_indices)
+            self.current_preview = False
+
+        return self.current_image
+
+    def get_last_number(self, path):
         last = 0
+        extensions = {encoder['extension'] for encoder in ENCODERS.values()}
         with os.scandir(path) as scan:
             for file in scan:
-                if file.is_file() and file.name.split('.')[-1].lower() == 'png':
+                if file.is_file() and file.name.split('.')[-1].lower() in extensions:
                     try:
                         n = int('.'.join(file.name.split('.')[:-1]))
                         if n > last:
@@ -189,7 +1603,252 @@ class Mixer:
                     except:
                         pass
 
-        self.current_image.save(f'{path}/{last+1}.png')
+        return last
+
+    def reserve_numbers(self, path, count=1, run=None):
+        counter = self.output_counters.get(path)
+        if counter is None:
+            counter = self.output_counters.setdefault(path, OutputCounter(path, lambda: self.get_last_number(path)))
+
+        return counter.reserve(count, run)
+
+    def release_numbers(self, path, first, count=1):
+        counter = self.output_counters.get(path)
+        if counter is not None:
+            counter.release(first, count)
+
+    def write_image(self, image, path, number):
+        # Encoded in memory first, so encoding and writing to disk are measured separately
+        encoder = ENCODERS[self.encoder]
+        start = self.timings.start()
+        buffer = io.BytesIO()
+        image.save(buffer, encoder['format'], **encoder['options'])
+        start = self.timings.add('encode', start)
+        with open(f'{path}/{number}.{encoder["extension"]}', 'wb') as file:
+            file.write(buffer.getbuffer())
+        self.timings.add('write', start)
+
+    def compare_encoders(self, samples=5):
+        # Encodes few generated images with every available encoder, returns speed and size of each one
+        images = [self.compose(self.sample_indices(random)) for _ in range(samples)]
+        report = []
+        for name in get_available_encoders():
+            encoder = ENCODERS[name]
+            size = 0
+            start = time.perf_counter()
+            for image in images:
+                buffer = io.BytesIO()
+                image.save(buffer, encoder['format'], **encoder['options'])
+                size += buffer.tell()
+            elapsed = time.perf_counter() - start
+
+            report.append({
+                'encoder': name,
+                'images_per_second': samples / elapsed if elapsed else 0,
+                'bytes_per_image': size // samples if samples else 0
+            })
+
+        return report
+
+    def save(self, path, number=None, result=None):
+        # Saves given result of generate_image, or the current image when there is none
+        start = self.timings.start()
+        if number is None:
+            number = self.reserve_numbers(path)
+
+        if result is None:
+            self.write_image(self.get_full_image(), path, number)
+            self.record_metadata(path, number, self.current_traits, self.current_seed)
+        else:
+            self.write_image(self.get_full_image(result), path, number)
+            self.record_metadata(path, number, result.traits, result.seed)
+        self.timings.add('save', start)
+
+    def get_timings(self):
+        # Count, total, mean and maximum duration (in seconds) and histogram of every measured stage
+        return self.timings.get()
+
+    def get_metadata_path(self, path, format=None):
+        return f'{path}/metadata.{format or self.metadata_format}'
+
+    def record_metadata(self, path, number, traits, seed=None):
+        if not self.metadata_format:
+            return
+
+        start = self.timings.start()
+        key = (path, self.metadata_format)
+        writer = self.metadata_writers.get(key)
+        if writer is None:
+            # Writing threads may record first images at once, only one of them may open the file
+            with self.metadata_lock:
+                writer = self.metadata_writers.get(key)
+                if writer is None:
+                    writer = self.metadata_writers[key] = MetadataWriter(self.get_metadata_path(path), self.data, self.metadata_format)
+        writer.write(number, traits, seed)
+        self.timings.add('metadata', start)
+
+    def flush_metadata(self):
+        for writer in list(self.metadata_writers.values()):
+            writer.flush()
+
+    def close_metadata(self):
+        writers = self.metadata_writers
+        self.metadata_writers = {}
+        for writer in writers.values():
+            writer.close()
+
+    def read_metadata(self, path):
+        # Yields (number, traits, seed) of every image recorded in metadata file of given output directory
+        with open(self.get_metadata_path(path), 'r', newline='', encoding='utf-8') as file:
+            if self.metadata_format == 'csv':
+                for row in csv.DictReader(file):
+                    number = int(row.pop('number'))
+                    seed = row.pop('seed')
+                    yield number, row, int(seed) if seed else None
+            else:
+                for line in file:
+                    if line.strip():
+                        record = json.loads(line)
+                        yield record['number'], record['traits'], record['seed']
+
+    def export_token_files(self, path, output=None):
+        # Writes separate JSON file for every image recorded in metadata file, in one pass after generating
+        self.flush_metadata()
+        output = output or path + '/json'
+        if not os.path.isdir(output):
+            os.makedirs(output)
+
+        count = 0
+        for number, traits, seed in self.read_metadata(path):
+            token = {
+                'name': f'#{number}',
+                'seed': seed,
+                'attributes': [{'trait_type': layer, 'value': traits[layer]} for layer in traits]
+            }
+            with open(f'{output}/{number}.json', 'w') as file:
+                file.write(json.dumps(token))
+            count += 1
+
+        return count
+
+    def get_checkpoint_path(self, path):
+        return f'{path}/{CHECKPOINT_FILENAME}'
+
+    def get_checkpoint_layers(self):
+        # Checkpoint can be resumed only with the same items and rarity
+        return {layer: [list(sampler.items), list(sampler.weights)] for layer, sampler in self.samplers.items()}
+
+    def save_checkpoint(self, path, last_number, run=None, completed=False):
+        # All images up to 'last_number' have to be written already (see ImageWriter.wait).
+        # Numbers of the run have to be reserved with the same 'run' (see ImageWriter), completed run is never resumed.
+        self.flush_metadata()
+        checkpoint_path = self.get_checkpoint_path(path)
+        metadata_path = self.get_metadata_path(path) if self.metadata_format else None
+        checkpoint = {
+            'last_number': last_number,
+            'collection_seed': self.collection_seed,
+            'next_token': self.next_token,
+            'unique': self.unique,
+            'metadata_format': self.metadata_format,
+            'metadata_offset': os.path.getsize(metadata_path) if metadata_path and os.path.isfile(metadata_path) else 0,
+            'layers': self.get_checkpoint_layers(),
+            'run': run,
+            'completed': completed
+        }
+
+        # Files are replaced at once, so checkpoint stays valid if program is killed while writing it
+        if self.unique:
+            self.save_seen_combinations(checkpoint_path + '.tmp')
+            os.replace(checkpoint_path + '.tmp', checkpoint_path + '.npz')
+        with open(checkpoint_path + '.tmp', 'w') as file:
+            file.write(json.dumps(checkpoint))
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+    def load_checkpoint(self, path):
+        # Restores state saved by save_checkpoint, returns None if there is no checkpoint to continue in given directory
+        checkpoint_path = self.get_checkpoint_path(path)
+        if not os.path.isfile(checkpoint_path):
+            return None
+
+        try:
+            with open(checkpoint_path, 'r') as file:
+                checkpoint = json.loads(file.read())
+            last_number = int(checkpoint['last_number'])
+            next_token = int(checkpoint['next_token'])
+            collection_seed = checkpoint['collection_seed']
+        except:
+            raise CheckpointFileError
+
+        if checkpoint.get('layers') != self.get_checkpoint_layers():
+            raise CheckpointFileError
+
+        # Images and metadata after the checkpoint are overwritten, so that is done only if all of them belong to the run itself.
+        # Anything saved into the directory since (manually or by another run) makes checkpoint outdated.
+        run = checkpoint.get('run')
+        self.output_counters.pop(path, None)
+        last, owner, first = OutputCounter(path, None).get()
+        if checkpoint.get('completed') or not run or owner != run or first > last_number + 1 or last < last_number:
+            return None
+
+        format = checkpoint.get('metadata_format')
+        metadata_path = self.get_metadata_path(path, format) if format else None
+        if metadata_path and (os.path.getsize(metadata_path) if os.path.isfile(metadata_path) else 0) < checkpoint['metadata_offset']:
+            return None
+
+        self.seen_combinations = None
+        if checkpoint.get('unique'):
+            try:
+                self.load_seen_combinations(checkpoint_path + '.npz')
+            except UniquenessFileError:
+                raise CheckpointFileError
+
+        # Metadata recorded after checkpoint belongs to images which will be generated again
+        if format:
+            for key in [key for key in self.metadata_writers if key[0] == path]:
+                self.metadata_writers.pop(key).close()
+            if os.path.isfile(metadata_path) and os.path.getsize(metadata_path) > checkpoint['metadata_offset']:
+                with open(metadata_path, 'r+b') as file:
+                    file.truncate(checkpoint['metadata_offset'])
+
+        self.collection_seed = collection_seed
+        self.next_token = next_token
+        OutputCounter(path, None).set(last_number, run, first)
+
+        return checkpoint
+
+    def generate_batch(self, n, path, workers=None):
+        first = self.reserve_numbers(path, n)
+        start = self.timings.start()
+        try:
+            if self.collection_seed is not None:
+                keys = get_token_keys(self.collection_seed, np.arange(first - 1, first - 1 + n)) # Token of image number i is i-1
+            else:
+                keys = np.random.default_rng().integers(0, MASK64, size=n, dtype=np.uint64, endpoint=True)
+            indices = self.sample_unique_batch(n, keys=keys) if self.unique else self.sample_batch(n, keys=keys)
+        except:
+            self.release_numbers(path, first, n) # Nothing was written, so failed batch leaves no gap in numbering
+            raise
+        self.timings.add('sample_batch', start)
+
+        # Images sharing bottom traits are sent to workers together, so they hit prefix cache
+        order = np.lexsort(indices[:, :self.prefix_depth].T[::-1]).tolist() if self.prefix_depth and len(indices) else range(n)
+        rows = indices.tolist()
+        seeds = keys.tolist()
+        tasks = [(path, first + i, rows[i]) for i in order]
+        workers = workers or os.cpu_count() or 1
+        chunksize = max(1, min(64, n // (workers * 4)))
+
+        # Returns list of (number, traits) tuples ordered by image number
+        results = []
+        with multiprocessing.Pool(workers, initializer=init_batch_worker, initargs=(self,)) as pool:
+            for number, traits, timings in pool.imap_unordered(generate_batch_item, tasks, chunksize):
+                if timings:
+                    self.timings.merge(timings) # Stages measured in worker process
+                self.record_metadata(path, number, traits, seeds[number - first])
+                results.append((number, traits))
+
+        self.flush_metadata()
+        return sorted(results)
 
     def count_exception_rules(self):
         if self.exception_list != None:
@@ -203,4 +1862,156 @@ class Mixer:
                 if self.rarity_levels[item] == weight:
                     result[weight] = result.get(weight, []) + [item]
 
-        return result
\ No newline at end of file
+        return result
+
+
+def add_input_arguments(parser, pack=True):
+    parser.add_argument('--components', help='directory with your components')
+    parser.add_argument('--layers', help='file with layers order')
+    parser.add_argument('--exceptions', default='', help='file with exceptions (optional)')
+    parser.add_argument('--rarity', default='', help='name of rarity files (optional)')
+    parser.add_argument('--manifest', default=None, help='file caching results of scanning components between runs (optional)')
+    if pack:
+        parser.add_argument('--pack', default=None, help='asset pack built with "pack" command, replaces all of the above')
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(prog='python -m mixer', description='Generate NFTs without the graphical interface.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate = subparsers.add_parser('generate', help='generate images into the output directory')
+    add_input_arguments(generate)
+    generate.add_argument('--count', type=int, required=True, help='number of images to generate')
+    generate.add_argument('--out', required=True, help='output directory')
+    generate.add_argument('--workers', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    generate.add_argument('--encoder', default='png', choices=list(ENCODERS), help='output format (default: png)')
+    generate.add_argument('--metadata', default=None, choices=['jsonl', 'csv'], help='append traits of every image to metadata file in the output directory')
+    generate.add_argument('--token-files', action='store_true', help='additionally write JSON file for every image recorded in metadata file')
+    generate.add_argument('--seed', type=int, default=None, help='collection seed, image number i always gets the same traits for the same seed')
+    generate.add_argument('--unique', action='store_true', help='never generate the same combination twice')
+    generate.add_argument('--seen', default=None, help='file with already generated combinations, used with --unique to keep resumed runs unique')
+    generate.add_argument('--timings', action='store_true', help='print time spent in every stage of generating')
+
+    encoders = subparsers.add_parser('encoders', help='compare speed and size of available output formats')
+    add_input_arguments(encoders)
+    encoders.add_argument('--samples', type=int, default=5, help='number of images encoded by every encoder')
+
+    probabilities = subparsers.add_parser('probabilities', help='print probability of every trait')
+    add_input_arguments(probabilities)
+
+    pack = subparsers.add_parser('pack', help='convert components directory into a single asset pack file')
+    add_input_arguments(pack, pack=False)
+    pack.add_argument('--out', required=True, help='asset pack file')
+
+    return parser.parse_args(args)
+
+def load_mixer(args):
+    # Returns loaded Mixer or error message
+    mixer = Mixer()
+    if getattr(args, 'pack', None):
+        try:
+            mixer.load_asset_pack(args.pack)
+        except AssetPackError as e:
+            return None, str(e)
+
+    else:
+        if not args.components or not args.layers:
+            return None, 'Components path and layers order file are required!'
+        if not os.path.isdir(args.components):
+            return None, 'Components path does NOT exist!'
+
+        mixer.components_path = args.components
+        mixer.layers_order_path = args.layers
+        mixer.exceptions_path = args.exceptions
+        mixer.rarity_filename = args.rarity
+        mixer.manifest_path = args.manifest
+
+        try:
+            mixer.fetch_data()
+        except (ComponentsPathError, LayersOrderFileError) as e:
+            return None, str(e)
+
+    if not getattr(args, 'pack', None):
+        problems = mixer.validate_assets()
+        for problem in problems['converted']:
+            print(f'WARNING: {problem} is not RGBA, it will be converted', file=sys.stderr)
+        for problem in problems['resized']:
+            print(f'WARNING: {problem} has different size than {mixer.image_size[0]}x{mixer.image_size[1]}, it will be resized', file=sys.stderr)
+        for problem in problems['unreadable']:
+            print(f'WARNING: {problem} can\'t be read, it will be skipped', file=sys.stderr)
+
+    if not mixer.total_images:
+        return None, 'All directories are empty!'
+
+    return mixer, None
+
+def main(args=None):
+    args = parse_arguments(args)
+    mixer, error = load_mixer(args)
+    if error:
+        print(f'ERROR: {error}', file=sys.stderr)
+        return 1
+
+    if args.command == 'encoders':
+        for result in mixer.compare_encoders(args.samples):
+            print(f'{result["encoder"]:<16}{result["images_per_second"]:>10.1f} images/s{result["bytes_per_image"] / 1024:>12.1f} KiB/image')
+        return 0
+
+    if args.command == 'probabilities':
+        mixer.compute_trait_probabilities()
+        print(f'Probabilities are {"exact" if mixer.trait_probabilities_exact else "estimated"}')
+        for directory in mixer.trait_probabilities:
+            print(f'{directory}:')
+            for trait, probability in sorted(mixer.trait_probabilities[directory].items(), key=lambda x: -x[1]):
+                print(f'    {trait:<32}{probability * 100:>9.4f}%')
+        return 0
+
+    if args.command == 'pack':
+        mixer.build_asset_pack(args.out)
+        print(f'Packed {mixer.total_images} images into {args.out} ({os.path.getsize(args.out) / 1024 / 1024:.1f} MiB)')
+        return 0
+
+    if not args.encoder in get_available_encoders():
+        print(f'ERROR: Encoder {args.encoder} is not available!', file=sys.stderr)
+        return 1
+
+    mixer.encoder = args.encoder
+    mixer.metadata_format = args.metadata or ('jsonl' if args.token_files else None)
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+
+    mixer.collection_seed = args.seed
+    mixer.unique = args.unique
+    if args.unique and args.seen and os.path.isfile(args.seen):
+        try:
+            mixer.load_seen_combinations(args.seen)
+        except UniquenessFileError as e:
+            print(f'ERROR: {e}', file=sys.stderr)
+            return 1
+
+    start = time.perf_counter()
+    try:
+        results = mixer.generate_batch(args.count, args.out, args.workers)
+    except CombinationsExhaustedError as e:
+        print(f'ERROR: {e}', file=sys.stderr)
+        return 1
+    elapsed = time.perf_counter() - start
+
+    if args.unique and args.seen:
+        mixer.save_seen_combinations(args.seen)
+
+    if args.token_files:
+        mixer.export_token_files(args.out)
+    mixer.close_metadata()
+
+    if results:
+        print(f'Generated images {results[0][0]}-{results[-1][0]} in {elapsed:.2f}s ({len(results) / elapsed:.1f} images/s)')
+
+    if args.timings:
+        # Stages of worker processes run in parallel, so their totals can exceed elapsed time
+        for stage, timing in mixer.get_timings()['stages'].items():
+            print(f'{stage:<20}{timing["count"]:>10}{timing["mean"] * 1000:>12.3f} ms/call{timing["total"]:>12.2f}s total')
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,14 @@
-import sys, os, json, time
+import sys, os, json, time, random, threading, uuid
 from PyQt5 import QtWidgets, QtGui, QtCore
 from PyQt5.QtCore import Qt, pyqtSignal
 from PyQt5.QtWidgets import QApplication, QMainWindow
-from mixer import Mixer
-from exceptions import ComponentsPathError, LayersOrderFileError
+from mixer import Mixer, ImageWriter, ENCODERS, get_available_encoders
+from exceptions import ComponentsPathError, LayersOrderFileError, CombinationsExhaustedError, CheckpointFileError
+
+
+def get_frame(result):
+    # Raw pixels of generated image with its size and the result itself, ready to be displayed by QImage without converting
+    return (result.image.tobytes('raw', 'RGBA'), result.image.size, result)
 
 class Lexend(QtGui.QFont):
     def __init__(self, font_size, bold=False):
@@ -74,6 +79,16 @@ class Application(QMainWindow):
         self.layers_order_input_valid = False
         self.file_input_valid = True
         self.rarity_input_valid = True
+        self.current_result = None # Displayed image, the one which gets saved
+        self.preview_refresh_rate = 30 # Maximum number of displayed images per second while generating automatically
+        self.preview_timer = QtCore.QTimer()
+        self.preview_timer.setInterval(int(1000 / self.preview_refresh_rate))
+        self.preview_timer.timeout.connect(self.update_preview_frame)
+        self.performance_timer = QtCore.QTimer()
+        self.performance_timer.setInterval(1000)
+        self.performance_timer.timeout.connect(self.update_performance_label)
+        self.performance_count = 0
+        self.performance_time = 0
 
     def window_settings(self):
         self.setWindowTitle('NFTs Mixer')
@@ -372,8 +387,19 @@ class Application(QMainWindow):
         self.traits_label = QtWidgets.QLabel()
         self.traits_label.setFont(Lexend(self.status_font_size))
 
+        performance_title_label = QtWidgets.QLabel()
+        performance_title_label.setText('Performance:')
+        performance_title_label.setFont(Lexend(self.info_font_size))
+        performance_title_label.setAlignment(Qt.AlignCenter)
+
+        self.performance_label = QtWidgets.QLabel()
+        self.performance_label.setFont(Lexend(self.status_font_size))
+        self.performance_label.setText('---')
+
         self.traits_layout.addWidget(traits_title_label)
         self.traits_layout.addWidget(self.traits_label)
+        self.traits_layout.addWidget(performance_title_label)
+        self.traits_layout.addWidget(self.performance_label)
 
         self.result_layout.addWidget(self.generated_image)
         self.result_layout.addWidget(self.traits_layout_widget)
@@ -404,6 +430,11 @@ class Application(QMainWindow):
             else:
                 self.generated_image.setMaximumSize(width, height)
 
+        # Images which are only displayed don't need more pixels than the screen shows
+        maximum_size = self.generated_image.maximumSize()
+        pixel_ratio = self.devicePixelRatioF()
+        self.mixer.set_preview_size((int(maximum_size.width() * pixel_ratio), int(maximum_size.height() * pixel_ratio)))
+
     def hide_info_layout(self):
         if not self.info_layout_hidden:
             self.info_layout_hidden = True
@@ -443,6 +474,7 @@ class Application(QMainWindow):
         output_layout.addWidget(self.output_path_input)
         output_layout.addWidget(self.output_path_valid)
         self.settings_layout.addWidget(output_layout_widget)
+        self.create_encoder_layout()
 
         button_size = 100
 
@@ -495,6 +527,7 @@ class Application(QMainWindow):
         output_layout.addWidget(self.output_path_input)
         output_layout.addWidget(self.output_path_valid)
         self.settings_layout.addWidget(output_layout_widget)
+        self.create_encoder_layout()
 
         time_delay_layout = QtWidgets.QHBoxLayout()
         time_delay_layout_widget = QtWidgets.QWidget()
@@ -544,6 +577,28 @@ class Application(QMainWindow):
         auto_save_layout.addWidget(self.auto_save_dropdown)
         self.settings_layout.addWidget(auto_save_layout_widget)
 
+        unique_layout = QtWidgets.QHBoxLayout()
+        unique_layout_widget = QtWidgets.QWidget()
+        unique_layout_widget.setLayout(unique_layout)
+        unique_layout.setAlignment(Qt.AlignCenter)
+        unique_layout.setSpacing(15)
+
+        unique_label = QtWidgets.QLabel()
+        unique_label.setText('Unique images:')
+        unique_label.setFont(Lexend(self.status_font_size))
+        unique_label.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
+
+        self.unique_dropdown = QtWidgets.QComboBox()
+        self.unique_dropdown.addItems(['No', 'Yes'])
+        self.unique_dropdown.setCurrentText('Yes' if self.mixer.unique else 'No')
+        self.unique_dropdown.setFont(Lexend(self.status_font_size))
+        self.unique_dropdown.setCursor(QtGui.QCursor(Qt.PointingHandCursor))
+        self.unique_dropdown.currentTextChanged.connect(self.update_unique_state)
+
+        unique_layout.addWidget(unique_label)
+        unique_layout.addWidget(self.unique_dropdown)
+        self.settings_layout.addWidget(unique_layout_widget)
+
         button_size = 100
 
         self.start_button = QtWidgets.QPushButton()
@@ -574,6 +629,46 @@ class Application(QMainWindow):
         self.control_layout.addWidget(self.stop_button)
         self.control_layout.addWidget(self.save_button)
 
+    def create_encoder_layout(self):
+        encoder_layout = QtWidgets.QHBoxLayout()
+        encoder_layout_widget = QtWidgets.QWidget()
+        encoder_layout_widget.setLayout(encoder_layout)
+        encoder_layout.setAlignment(Qt.AlignCenter)
+        encoder_layout.setSpacing(15)
+
+        encoder_label = QtWidgets.QLabel()
+        encoder_label.setText('Output format:')
+        encoder_label.setFont(Lexend(self.status_font_size))
+        encoder_label.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
+
+        self.encoder_dropdown = QtWidgets.QComboBox()
+        for encoder in get_available_encoders():
+            self.encoder_dropdown.addItem(ENCODERS[encoder]['label'], encoder)
+        self.encoder_dropdown.setCurrentIndex(max(0, self.encoder_dropdown.findData(self.mixer.encoder)))
+        self.encoder_dropdown.setFont(Lexend(self.status_font_size))
+        self.encoder_dropdown.setCursor(QtGui.QCursor(Qt.PointingHandCursor))
+        self.encoder_dropdown.currentIndexChanged.connect(self.update_encoder)
+
+        metadata_label = QtWidgets.QLabel()
+        metadata_label.setText('Metadata:')
+        metadata_label.setFont(Lexend(self.status_font_size))
+        metadata_label.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
+
+        self.metadata_dropdown = QtWidgets.QComboBox()
+        self.metadata_dropdown.addItem('None', None)
+        self.metadata_dropdown.addItem('JSONL', 'jsonl')
+        self.metadata_dropdown.addItem('CSV', 'csv')
+        self.metadata_dropdown.setCurrentIndex(max(0, self.metadata_dropdown.findData(self.mixer.metadata_format)))
+        self.metadata_dropdown.setFont(Lexend(self.status_font_size))
+        self.metadata_dropdown.setCursor(QtGui.QCursor(Qt.PointingHandCursor))
+        self.metadata_dropdown.currentIndexChanged.connect(self.update_metadata_format)
+
+        encoder_layout.addWidget(encoder_label)
+        encoder_layout.addWidget(self.encoder_dropdown)
+        encoder_layout.addWidget(metadata_label)
+        encoder_layout.addWidget(self.metadata_dropdown)
+        self.settings_layout.addWidget(encoder_layout_widget)
+
     def clean_generating_mode_layouts(self):
         for i in reversed(range(self.settings_layout.count())):
             widget = self.settings_layout.itemAt(i).widget()
@@ -630,13 +725,16 @@ class Application(QMainWindow):
         self.mixer.layers_order_path = self.layers_order_input.text()
         self.mixer.exceptions_path = self.file_input.text()
         self.mixer.rarity_filename = self.rarity_input.text()
+        self.mixer.manifest_path = os.getcwd() + '/manifest.json' # Stored alongside config.json
 
         self.path_layout_widget.deleteLater()
         self.create_interface()
 
+        self.current_result = None
         self.fetch_data_thread = FetchDataThread(self.mixer)
         self.fetch_data_thread.finished.connect(self.update_general_info)
         self.fetch_data_thread.finished.connect(self.update_traits_label)
+        self.fetch_data_thread.counted.connect(self.update_general_info)
         self.fetch_data_thread.imageSizeChanged.connect(self.update_image_area)
         self.fetch_data_thread.error.connect(self.display_error)
         self.fetch_data_thread.start()
@@ -670,14 +768,14 @@ class Application(QMainWindow):
         path = self.output_path_input.text()
         if os.path.isdir(path):
             self.output_path_valid.setPixmap(self.get_valid_icon())
-            if self.mixer.current_image:
+            if self.current_result:
                 self.save_button.setDisabled(False)
         else:
             self.output_path_valid.setPixmap(self.get_invalid_icon())
             self.save_button.setDisabled(True)
 
     def update_auto_save_button(self):
-        if self.auto_save_dropdown.currentText() == 'No' and self.mixer.current_image and os.path.isdir(self.output_path_input.text()):
+        if self.auto_save_dropdown.currentText() == 'No' and self.current_result and os.path.isdir(self.output_path_input.text()):
             self.save_button.setDisabled(False)
         else:
             self.save_button.setDisabled(True)
@@ -691,6 +789,15 @@ class Application(QMainWindow):
     def update_auto_saving_state(self):
         self.mixer.auto_saving = True if self.auto_save_dropdown.currentText() == 'Yes' else False
 
+    def update_encoder(self):
+        self.mixer.encoder = self.encoder_dropdown.currentData()
+
+    def update_metadata_format(self):
+        self.mixer.metadata_format = self.metadata_dropdown.currentData()
+
+    def update_unique_state(self):
+        self.mixer.unique = True if self.unique_dropdown.currentText() == 'Yes' else False
+
     def update_time_delay_input(self):
         digits = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '.']
         text = self.time_delay_input.text()
@@ -800,10 +907,11 @@ class Application(QMainWindow):
                     content += '<br>'
             label.setText(content)
 
-    def update_traits_label(self):
+    def update_traits_label(self, traits=None):
+        traits = {} if traits is None else traits
         text = ''
         for trait in self.mixer.data:
-            text += f'{trait}: {self.mixer.current_traits.get(trait, "---")}<br>'
+            text += f'{trait}: {traits.get(trait, "---")}<br>'
         text = text[:-4] # Cut out last <br> tag
         self.traits_label.setText(text)
 
@@ -866,12 +974,43 @@ class Application(QMainWindow):
             else:
                 available_weights = available_weights[:-3] # Cut out " | "
 
+            rarest_traits = ''
+            if self.mixer.trait_probabilities:
+                traits = []
+                for directory in self.mixer.trait_probabilities:
+                    for trait, probability in self.mixer.trait_probabilities[directory].items():
+                        if trait != 'none' and probability > 0:
+                            traits.append((probability, trait))
+                approximately = '' if self.mixer.trait_probabilities_exact else '~'
+                rarest_traits = ' | '.join(f'{trait} <b>{approximately}{probability * 100:.2f}%</b>' for probability, trait in sorted(traits)[:5])
+                rarest_traits = f'<br>Rarest traits: {rarest_traits}' if rarest_traits else ''
+
+            problems = self.mixer.asset_problems
+            asset_problems = []
+            if problems['converted']:
+                asset_problems.append(f'{len(problems["converted"])} not RGBA (converted)')
+            if problems['resized']:
+                asset_problems.append(f'{len(problems["resized"])} with different size (resized)')
+            if problems['unreadable']:
+                asset_problems.append(f'<span style=\'color: {self.error_color}\'>{len(problems["unreadable"])} unreadable (skipped)</span>')
+            asset_problems = f'<br>Asset problems: <span style=\'color: {self.warning_color}\'><b>{" | ".join(asset_problems)}</b></span>' if asset_problems else ''
+
+            possible_combinations = self.readable_number(self.mixer.possible_combinations)
+            if not self.mixer.combinations_counted:
+                possible_combinations = f'up to {possible_combinations} <span style=\'color: {self.hint_color}\'>(counting...)</span>'
+            elif not self.mixer.possible_combinations_exact and self.mixer.possible_combinations:
+                possible_combinations = f'~{possible_combinations} <span style=\'color: {self.hint_color}\'>(estimated)</span>'
+            elif self.mixer.effective_combinations:
+                possible_combinations += f' <span style=\'color: {self.hint_color}\'>(effectively {self.readable_number(round(self.mixer.effective_combinations))} with weights)</span>'
+
             self.summary_info.setText(
                 f'Total images: <b>{self.readable_number(self.mixer.total_images)}</b><br>'
-                f'Total possible combinations: <b>{self.readable_number(self.mixer.possible_combinations)}</b><br>'
+                f'Total possible combinations: <b>{possible_combinations}</b><br>'
                 f'Number of exception rules: <b>{exception_rules if exception_rules != None else exception_rules_error}</b><br>'
                 f'Number of rarity files: <b>{rarity_files}</b><br>'
                 f'Available weights: {available_weights}'
+                f'{rarest_traits}'
+                f'{asset_problems}'
             )
 
     def update_generating_mode(self):
@@ -901,13 +1040,52 @@ class Application(QMainWindow):
         self.available_directories_label.setText(f'<span style=\'color: {self.error_color}\'>{message}</span>')
         self.disable_generating_controls(True)
 
-    def update_generated_image(self, image):
-        image = QtGui.QImage(image.tobytes('raw', 'RGBA'), *self.generated_image_size, QtGui.QImage.Format_RGBA8888)
+    def display_generating_error(self, message):
+        self.stop_generating()
+        self.traits_label.setText(f'<span style=\'color: {self.error_color}\'>{message}</span>')
+
+    def update_generated_image(self, result):
+        self.display_frame(get_frame(result))
+
+    def display_frame(self, frame):
+        data, (width, height), result = frame
+        self.current_result = result
+        # QImage only points to the buffer, pixels are copied once into the pixmap
+        image = QtGui.QImage(data, width, height, width * 4, QtGui.QImage.Format_RGBA8888) # Preview can be smaller than generated_image_size
         pixmap = QtGui.QPixmap()
         pixmap = pixmap.fromImage(image)
         self.generated_image.setPixmap(pixmap)
         self.generated_image.setMinimumSize(1, 1)
-        self.update_traits_label()
+        self.update_traits_label(result.traits)
+
+    def update_preview_frame(self):
+        # Only the latest image is displayed, images generated in the meantime are skipped
+        thread = self.start_image_generating_thread
+        finished = thread.isFinished() # Checked first, so the last image isn't missed
+        frame = thread.take_frame()
+        if frame:
+            self.display_frame(frame)
+            self.update_auto_save_button()
+        if finished:
+            self.preview_timer.stop()
+            if self.performance_timer.isActive():
+                self.performance_timer.stop()
+                self.update_performance_label()
+
+    def update_performance_label(self):
+        # Images per second since last update and average duration of every stage in current run
+        stages = self.mixer.get_timings()['stages']
+        count = stages['generate']['count'] if 'generate' in stages else 0
+        now = time.perf_counter()
+        rate = (count - self.performance_count) / (now - self.performance_time) if now > self.performance_time else 0
+        self.performance_count = count
+        self.performance_time = now
+
+        text = f'{rate:.1f} images/s'
+        for stage in ['sample', 'decode', 'compose', 'encode', 'write', 'metadata']:
+            if stage in stages:
+                text += f'<br>{stage}: {stages[stage]["mean"] * 1000:.2f} ms'
+        self.performance_label.setText(text)
 
     def generate_image(self):
         self.generate_image_thread = GenerateImageThread(self.mixer)
@@ -917,7 +1095,7 @@ class Application(QMainWindow):
 
     def save_image(self):
         path = self.output_path_input.text()
-        self.save_image_thread = SaveImageThread(path, self.mixer)
+        self.save_image_thread = SaveImageThread(path, self.mixer, self.current_result)
         self.save_image_thread.start()
 
     def start_generating(self):
@@ -928,10 +1106,17 @@ class Application(QMainWindow):
 
         path = self.output_path_input.text()
         delay = self.time_delay_input.text()
-        self.start_image_generating_thread = StartImageGeneratingThread(path, delay, self.mixer)
-        self.start_image_generating_thread.generated.connect(self.update_generated_image)
-        self.start_image_generating_thread.generated.connect(self.update_auto_save_button)
+        # Performance breakdown shows only the current run
+        self.mixer.timings.reset()
+        self.performance_count = 0
+        self.performance_time = time.perf_counter()
+
+        self.start_image_generating_thread = StartImageGeneratingThread(path, delay, self.mixer, 1 / self.preview_refresh_rate)
+        self.start_image_generating_thread.error.connect(self.display_generating_error)
         self.start_image_generating_thread.start()
+        self.preview_timer.start()
+        if self.mixer.timings.enabled:
+            self.performance_timer.start()
 
     def stop_generating(self):
         self.mixer.auto_generating = False
@@ -965,6 +1150,7 @@ class FetchDataThread(QtCore.QThread):
     finished = pyqtSignal()
     error = pyqtSignal(str)
     imageSizeChanged = pyqtSignal()
+    counted = pyqtSignal()
     def __init__(self, mixer):
         super().__init__()
         self.mixer = mixer
@@ -972,6 +1158,7 @@ class FetchDataThread(QtCore.QThread):
     def run(self):
         try:
             self.mixer.fetch_data()
+            self.mixer.validate_assets()
         except ComponentsPathError:
             self.error.emit('Error while reading components path!')
         except LayersOrderFileError:
@@ -979,6 +1166,9 @@ class FetchDataThread(QtCore.QThread):
         else:
             self.finished.emit()
             self.imageSizeChanged.emit()
+            self.mixer.count_possible_combinations() # Dashboard is shown first, counting can take a while
+            self.mixer.compute_trait_probabilities()
+            self.counted.emit()
 
 class GenerateImageThread(QtCore.QThread):
     finished = pyqtSignal(object)
@@ -987,35 +1177,100 @@ class GenerateImageThread(QtCore.QThread):
         self.mixer = mixer
 
     def run(self):
-        image = self.mixer.generate()
-        self.finished.emit(image)
+        result = self.mixer.generate_image(preview=True) # Full size is rendered only if image gets saved
+        self.finished.emit(result)
 
 class SaveImageThread(QtCore.QThread):
-    def __init__(self, path, mixer):
+    def __init__(self, path, mixer, result):
         super().__init__()
         self.path = path
         self.mixer = mixer
+        self.result = result
 
     def run(self):
-        self.mixer.save(self.path)
+        self.mixer.save(self.path, result=self.result)
+        self.mixer.flush_metadata()
 
 class StartImageGeneratingThread(QtCore.QThread):
-    generated = pyqtSignal(object)
-    def __init__(self, path, delay, mixer):
+    error = pyqtSignal(str)
+    def __init__(self, path, delay, mixer, frame_interval):
         super().__init__()
         self.path = path
         self.delay = float(delay)
         self.mixer = mixer
+        self.frame_interval = frame_interval # Minimum time between images prepared for display
+        self.frame = None
+        self.frame_time = 0
+        self.frame_lock = threading.Lock()
+
+    def set_frame(self, result):
+        # Pixels are copied here, off the GUI thread, and only as often as they can be displayed
+        frame = get_frame(result)
+        with self.frame_lock:
+            self.frame = frame
+        self.frame_time = time.perf_counter()
+
+    def take_frame(self):
+        with self.frame_lock:
+            frame = self.frame
+            self.frame = None
+        return frame
 
     def run(self):
+        writer = None
+        last_number = None
+        pending = None # Last image which wasn't prepared for display yet
+        failed = False
+        run = uuid.uuid4().hex # Marks numbers reserved by this run, see Mixer.load_checkpoint
         self.mixer.auto_generating = True
+        if self.mixer.auto_saving and os.path.isdir(self.path):
+            # Interrupted run in the same output directory is continued from its last checkpoint
+            try:
+                checkpoint = self.mixer.load_checkpoint(self.path)
+            except CheckpointFileError:
+                checkpoint = None
+            if checkpoint:
+                last_number = checkpoint['last_number']
+                run = checkpoint['run']
+        if self.mixer.collection_seed is None:
+            self.mixer.collection_seed = random.getrandbits(64) # Makes run reproducible from checkpoint
+
         while self.mixer.auto_generating:
-            image = self.mixer.generate()
-            self.generated.emit(image)
+            try:
+                result = self.mixer.generate_image(preview=not self.mixer.auto_saving)
+            except CombinationsExhaustedError as e:
+                self.error.emit(str(e))
+                break
+            pending = result
+            if time.perf_counter() - self.frame_time >= self.frame_interval:
+                self.set_frame(pending)
+                pending = None
             if self.mixer.auto_saving:
-                self.mixer.save(self.path)
+                # Images are encoded and written in background while generating continues
+                writer = writer or ImageWriter(self.mixer, self.path, run=run)
+                try:
+                    last_number = writer.put(result.image, result.traits, result.seed)
+                    if not last_number % self.mixer.checkpoint_interval:
+                        writer.wait()
+                        self.mixer.save_checkpoint(self.path, last_number, run)
+                except Exception as e:
+                    self.error.emit(f'Error while saving image: {e}')
+                    failed = True
+                    break
             time.sleep(self.delay)
 
+        if pending:
+            self.set_frame(pending)
+
+        if writer:
+            try:
+                writer.close()
+                if not failed:
+                    self.mixer.save_checkpoint(self.path, last_number, run, completed=True) # Stopped run is not continued
+            except Exception as e:
+                self.error.emit(f'Error while saving image: {e}')
+            self.mixer.flush_metadata()
+
 
 class SaveConfigurationThread(QtCore.QThread):
     def __init__(self, mixer):